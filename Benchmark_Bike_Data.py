@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from Stage_Instrumentation import stage
+from Download_Bike_Data import (parse_trip_timestamps, TIMESTAMP_PARTS, TRIP_COLUMNS, import_bike_data,
+                                pre_processing_bike_data, save_bike_data, read_bike_data, process_bike_data_in_chunks)
+
+SYNTHETIC_STATIONS = 850
+SYNTHETIC_BIKES = 15000
+SYNTHETIC_MAX_TRIP_MINUTES = 180
+
+# Stages run by benchmark_pipeline, in order
+BENCHMARK_STAGES = ['generate', 'import', 'pre_process', 'save', 'read', 'chunked']
+
+# Function to generate TfL formatted start/end timestamp columns
+def make_timestamp_columns(n_rows, seed=0):
+    """
+    Return (start, end) Series of 'dd/mm/YYYY HH:MM' strings for n_rows random trips in 2016-2019.
+    Each distinct minute is formatted once and repeated, as in the real files.
+    """
+    rng = np.random.default_rng(seed)
+    minutes = pd.date_range('2016-01-01', '2019-12-31 23:59', freq='min')
+    formatted = minutes.strftime('%d/%m/%Y %H:%M').to_numpy(dtype=object)
+
+    start_codes = rng.integers(0, len(minutes) - 180, n_rows)
+    end_codes = start_codes + rng.integers(1, 180, n_rows)
+    return pd.Series(formatted[start_codes]), pd.Series(formatted[end_codes])
+
+# Function that derives the timestamp parts the way pre_processing_bike_data used to
+def legacy_timestamp_parts(start, end):
+    """
+    Parse every row with pd.to_datetime and derive each part with its own .dt accessor pass.
+    """
+    results = []
+    for column in (start, end):
+        timestamp = pd.to_datetime(column.str.slice(0, 16), format='%d/%m/%Y %H:%M')
+        results.append({
+            'timestamp': timestamp,
+            'date': pd.to_datetime(timestamp.dt.date),
+            'day': timestamp.dt.day,
+            'month': timestamp.dt.month,
+            'year': timestamp.dt.year,
+            'hour': timestamp.dt.hour,
+            'day_of_week': timestamp.dt.day_name(),
+        })
+    return results
+
+# Function to time the legacy and the cached timestamp parsing on the same data
+def benchmark_timestamp_parsing(n_rows=10_000_000, repeat=3):
+    """
+    Time legacy_timestamp_parts against parse_trip_timestamps, check they agree, and print the best of repeat runs.
+    """
+    start, end = make_timestamp_columns(n_rows)
+    timings = {}
+
+    for name, parse in (('legacy', legacy_timestamp_parts), ('cached', parse_trip_timestamps)):
+        best = None
+        for _ in range(repeat):
+            began = time.perf_counter()
+            results = parse(start, end)
+            elapsed = time.perf_counter() - began
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = (best, results)
+
+    legacy, cached = timings['legacy'][1], timings['cached'][1]
+    for legacy_parts, cached_parts in zip(legacy, cached):
+        for part in ['timestamp', 'date'] + TIMESTAMP_PARTS:
+            assert np.array_equal(np.asarray(legacy_parts[part]), np.asarray(cached_parts[part], dtype=np.asarray(legacy_parts[part]).dtype)), part
+
+    print(f"Timestamp parsing of {n_rows} rows (best of {repeat}):")
+    for name, (elapsed, _) in timings.items():
+        print(f"  {name:<8}{elapsed:8.2f}s {n_rows / elapsed:14,.0f} rows/s")
+    print(f"  speed-up {timings['legacy'][0] / timings['cached'][0]:.1f}x")
+
+
+# Function to format every minute of a period once
+@lru_cache(maxsize=None)
+def formatted_minutes(start, end):
+    """
+    Return an object array with every minute from start to end formatted as 'dd/mm/YYYY HH:MM'.
+    Only the days and the minutes of a day are formatted, the strings are joined from those.
+    """
+    timestamps = pd.date_range(start, end, freq='min')
+    days = pd.date_range(timestamps[0].normalize(), timestamps[-1].normalize(), freq='D')
+    day_strings = days.strftime('%d/%m/%Y ').to_numpy(dtype=object)
+    time_strings = np.array([f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(1440)], dtype=object)
+
+    day_index = (timestamps.normalize() - days[0]).days.to_numpy()
+    minute_of_day = (timestamps.hour * 60 + timestamps.minute).to_numpy()
+    return day_strings[day_index] + time_strings[minute_of_day]
+
+# Function to generate one synthetic trip file
+def generate_trip_frame(n_rows, first_rental_id, first_minute, last_minute, seed, missing_rate=0.001,
+                        start='2016-01-01', end='2019-12-31 23:59'):
+    """
+    Return n_rows random trips in the TfL usage-stats schema (TRIP_COLUMNS), starting between the given
+    minute offsets of the period. Durations agree with the start and end times, and a missing_rate share
+    of trips has no end station or end date, as trips do in the real files.
+    """
+    rng = np.random.default_rng(seed)
+    minutes = formatted_minutes(start, end)
+    last_minute = min(last_minute, len(minutes) - SYNTHETIC_MAX_TRIP_MINUTES - 1)
+
+    start_minute = np.sort(rng.integers(first_minute, last_minute + 1, n_rows))
+    trip_minutes = rng.integers(1, SYNTHETIC_MAX_TRIP_MINUTES, n_rows)
+    start_station = rng.integers(1, SYNTHETIC_STATIONS + 1, n_rows)
+    end_station = rng.integers(1, SYNTHETIC_STATIONS + 1, n_rows)
+    station_names = np.array([f"Station {station_id}, Synthetic" for station_id in range(SYNTHETIC_STATIONS + 1)], dtype=object)
+
+    end_station_id = pd.array(end_station, dtype='Int16')
+    end_date = minutes[start_minute + trip_minutes]
+    end_name = station_names[end_station]
+    missing = rng.random(n_rows) < missing_rate
+    end_station_id[missing] = pd.NA
+    end_date[missing] = None
+    end_name[missing] = None
+
+    return pd.DataFrame({
+        'Rental Id': np.arange(first_rental_id, first_rental_id + n_rows, dtype=np.int64),
+        'Duration': trip_minutes * 60 + rng.integers(0, 60, n_rows),
+        'Bike Id': rng.integers(1, SYNTHETIC_BIKES + 1, n_rows),
+        'End Date': end_date,
+        'EndStation Id': end_station_id,
+        'EndStation Name': end_name,
+        'Start Date': minutes[start_minute],
+        'StartStation Id': start_station,
+        'StartStation Name': station_names[start_station],
+    }, columns=TRIP_COLUMNS)
+
+# Function to write a synthetic set of raw trip files
+def generate_trip_files(directory, n_rows, rows_per_file=1_000_000, seed=0, start='2016-01-01', end='2019-12-31 23:59'):
+    """
+    Write n_rows synthetic trips to directory as raw TfL CSV files of rows_per_file rows each.
+
+    Like the real weekly extracts, every file covers its own consecutive slice of the period and
+    Rental Ids increase across files. The output depends only on the arguments, so the same scale
+    and seed always produce the same files. Returns the list of files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    n_files = max(1, -(-n_rows // rows_per_file))
+    n_minutes = len(formatted_minutes(start, end))
+    filepaths = []
+
+    for file_number in range(n_files):
+        first_row = file_number * rows_per_file
+        file_rows = min(rows_per_file, n_rows - first_row)
+        first_minute = n_minutes * file_number // n_files
+        last_minute = n_minutes * (file_number + 1) // n_files - 1
+
+        trips = generate_trip_frame(file_rows, first_row, first_minute, last_minute, seed=(seed, file_number),
+                                    start=start, end=end)
+        filepath = os.path.join(directory, f"{file_number:04d}JourneyDataExtract-synthetic.csv")
+        trips.to_csv(filepath, index=False)
+        filepaths.append(filepath)
+
+    return filepaths
+
+# Function to time one stage and record its peak memory
+def measure_stage(name, rows, function, *args, **kwargs):
+    """
+    Run function(*args, **kwargs) and return (result, record) where record holds the stage's wall time,
+    rows per second and the peak resident memory of the process while it ran, as measured by stage().
+    Memory still held from earlier stages counts towards the peak.
+    """
+    with stage(f"benchmark:{name}") as measured:
+        result = function(*args, **kwargs)
+
+    elapsed = measured.get('seconds', np.nan)
+    record = {'stage': name, 'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed if elapsed else np.nan,
+              'peak_rss_mb': measured.get('peak_rss_mb', np.nan)}
+    return result, record
+
+# Function to benchmark every pipeline stage on synthetic data at several scales
+def benchmark_pipeline(scales=(1_000_000,), stages=BENCHMARK_STAGES, rows_per_file=1_000_000, seed=0, workdir=None):
+    """
+    Generate n_rows synthetic trips for every scale and run the selected stages on them: generating the
+    raw files, import_bike_data, pre_processing_bike_data, save_bike_data, read_bike_data and the
+    bounded-memory process_bike_data_in_chunks.
+
+    The in-memory stages hold the whole scale at once, so leave them out of stages for scales that do not
+    fit in memory. Prints a table per scale and returns all records as a DataFrame.
+    """
+    records = []
+    for n_rows in scales:
+        directory = tempfile.mkdtemp(prefix=f"bike_benchmark_{n_rows}_", dir=workdir)
+        raw_dir = os.path.join(directory, 'raw')
+        bike_data = None
+        try:
+            _, record = measure_stage('generate', n_rows, generate_trip_files, raw_dir, n_rows, rows_per_file, seed)
+            records.append(dict(record, scale=n_rows))
+
+            if 'import' in stages:
+                bike_data, record = measure_stage('import', n_rows, import_bike_data, raw_dir)
+                records.append(dict(record, scale=n_rows))
+            if 'pre_process' in stages and bike_data is not None:
+                bike_data, record = measure_stage('pre_process', n_rows, pre_processing_bike_data, bike_data)
+                records.append(dict(record, scale=n_rows))
+            if 'save' in stages and bike_data is not None:
+                _, record = measure_stage('save', len(bike_data), save_bike_data, bike_data, os.path.join(directory, 'store'))
+                records.append(dict(record, scale=n_rows))
+                rows = len(bike_data)
+                bike_data = None
+                if 'read' in stages:
+                    _, record = measure_stage('read', rows, read_bike_data, path=os.path.join(directory, 'store'))
+                    records.append(dict(record, scale=n_rows))
+            bike_data = None
+
+            if 'chunked' in stages:
+                _, record = measure_stage('chunked', n_rows, process_bike_data_in_chunks, raw_dir,
+                                          os.path.join(directory, 'chunked_store'),
+                                          rental_id_index_file=os.path.join(directory, 'rental_id_index.npz'))
+                records.append(dict(record, scale=n_rows))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        results = pd.DataFrame([record for record in records if record['scale'] == n_rows])
+        print(f"Pipeline stages on {n_rows:,} synthetic trips:")
+        for record in results.itertuples():
+            print(f"  {record.stage:<12}{record.seconds:9.2f}s {record.rows_per_second:14,.0f} rows/s "
+                  f"{record.peak_rss_mb:10,.0f} MB peak")
+
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+    # python Benchmark_Bike_Data.py [--timestamps] [rows ...]
+    if '--timestamps' in sys.argv:
+        benchmark_timestamp_parsing()
+    else:
+        scales = [int(arg) for arg in sys.argv[1:]] or [1_000_000]
+        benchmark_pipeline(scales)
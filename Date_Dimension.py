@@ -0,0 +1,156 @@
+import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+DAY_NAMES = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'], dtype=object)
+WEEKDAY_DTYPE = pd.CategoricalDtype(DAY_NAMES, ordered=True)
+
+# Key given to missing timestamps (the integer value of NaT)
+MISSING_KEY = np.iinfo(np.int64).min
+
+# Hours counted as peak hours on weekdays: 06:00-09:59 and 16:00-19:59
+PEAK_HOURS = [6, 7, 8, 9, 16, 17, 18, 19]
+
+# One-off bank holidays in England and Wales (jubilees, royal events, the millennium)
+SPECIAL_BANK_HOLIDAYS = [
+    datetime.date(1999, 12, 31),
+    datetime.date(2002, 6, 3),
+    datetime.date(2011, 4, 29),
+    datetime.date(2012, 6, 5),
+    datetime.date(2022, 6, 3),
+    datetime.date(2022, 9, 19),
+    datetime.date(2023, 5, 8),
+]
+
+# Years in which a regular bank holiday was moved to another date
+MOVED_BANK_HOLIDAYS = {
+    (1995, 'early_may'): datetime.date(1995, 5, 8),
+    (2002, 'spring'): datetime.date(2002, 6, 4),
+    (2012, 'spring'): datetime.date(2012, 6, 4),
+    (2020, 'early_may'): datetime.date(2020, 5, 8),
+    (2022, 'spring'): datetime.date(2022, 6, 2),
+}
+
+# Function to compute the date of Easter Sunday
+def easter_sunday(year):
+    """
+    Return Easter Sunday of the given year (anonymous Gregorian algorithm).
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+# Function to find the first or last given weekday of a month
+def nth_weekday(year, month, weekday, last=False):
+    if last:
+        next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+        day = next_month - datetime.timedelta(days=1)
+        return day - datetime.timedelta(days=(day.weekday() - weekday) % 7)
+    day = datetime.date(year, month, 1)
+    return day + datetime.timedelta(days=(weekday - day.weekday()) % 7)
+
+# Function to list the bank holidays in England and Wales for a year
+def uk_bank_holidays(year):
+    """
+    Return the sorted list of bank holiday dates in England and Wales for the given year.
+    Holidays falling on a weekend are substituted by the next free weekday, and Christmas Day
+    itself is always included, even when the bank holiday moves to the 27th.
+    """
+    def regular(name, default):
+        return MOVED_BANK_HOLIDAYS.get((year, name), default)
+
+    easter = easter_sunday(year)
+    holidays = {
+        regular('good_friday', easter - datetime.timedelta(days=2)),
+        regular('easter_monday', easter + datetime.timedelta(days=1)),
+        regular('early_may', nth_weekday(year, 5, 0)),
+        regular('spring', nth_weekday(year, 5, 0, last=True)),
+        regular('summer', nth_weekday(year, 8, 0, last=True)),
+    }
+
+    # New Year's Day moves to Monday when it falls on a weekend
+    new_year = datetime.date(year, 1, 1)
+    holidays.add(new_year + datetime.timedelta(days=7 - new_year.weekday() if new_year.weekday() >= 5 else 0))
+
+    # Christmas and Boxing Day move to the next weekdays not already taken
+    christmas = datetime.date(year, 12, 25)
+    holidays.add(christmas)
+    day = christmas
+    for _ in range(2):
+        while day.weekday() >= 5 or day in holidays - {christmas}:
+            day += datetime.timedelta(days=1)
+        holidays.add(day)
+        day += datetime.timedelta(days=1)
+
+    holidays.update(date for date in SPECIAL_BANK_HOLIDAYS if date.year == year)
+    return sorted(holidays)
+
+# Function to build the hourly date dimension for a range of years
+@lru_cache(maxsize=None)
+def build_date_dimension(start_year, end_year):
+    """
+    Build one row per hour from 1 January start_year to 31 December end_year, indexed by the integer
+    date_hour_key (hours since 1970-01-01, see date_hour_keys).
+
+    Columns: date, year, month, day, hour, day_of_week, weekday, weekend, holiday,
+    peak_hour_of_day (the hour is a peak hour on any day) and peak_hour (a peak hour on a weekday).
+    """
+    hours = pd.date_range(f'{start_year}-01-01', f'{end_year}-12-31 23:00', freq='h')
+    holidays = [date for year in range(start_year, end_year + 1) for date in uk_bank_holidays(year)]
+    weekday = hours.dayofweek < 5
+    peak_hour_of_day = hours.hour.isin(PEAK_HOURS)
+
+    dimension = pd.DataFrame({
+        'date': hours.normalize(),
+        'year': hours.year.astype(np.int16),
+        'month': hours.month.astype(np.int8),
+        'day': hours.day.astype(np.int8),
+        'hour': hours.hour.astype(np.int8),
+        'day_of_week': pd.Categorical.from_codes(hours.dayofweek, dtype=WEEKDAY_DTYPE),
+        'weekday': weekday.astype(np.int8),
+        'weekend': (~weekday).astype(np.int8),
+        'holiday': hours.normalize().isin(pd.to_datetime(holidays)).astype(np.int8),
+        'peak_hour_of_day': peak_hour_of_day.astype(np.int8),
+        'peak_hour': (peak_hour_of_day & weekday).astype(np.int8),
+    }, index=pd.Index(date_hour_keys(hours), name='date_hour_key'))
+    return dimension
+
+# Function to turn timestamps into integer date/hour keys
+def date_hour_keys(timestamps):
+    """
+    Return hours since 1970-01-01 for each timestamp as int64, with MISSING_KEY for missing timestamps.
+    """
+    return np.asarray(timestamps, dtype='datetime64[h]').astype(np.int64)
+
+# Function to look up date dimension columns for an array of keys
+def lookup_calendar(keys, dimension, columns):
+    """
+    Return a dict of arrays with the requested dimension columns for each key, by array indexing
+    into the dimension. Missing keys get 0. Every other key must fall inside the dimension.
+    """
+    missing = keys == MISSING_KEY
+    positions = keys - dimension.index[0]
+    positions[missing] = 0
+
+    result = {}
+    for column in columns:
+        values = dimension[column].to_numpy()[positions]
+        values[missing] = 0
+        result[column] = values
+    return result
+
+
+if __name__ == "__main__":
+    date_dimension = build_date_dimension(2016, 2019)
+    date_dimension.to_csv('Final Data Files/date_dimension.csv')
+    print("Date dimension saved to CSV file.", date_dimension.shape)
@@ -0,0 +1,184 @@
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from Stage_Instrumentation import instrument_stage
+from Download_Bike_Data import TRIP_STORE_PATH, TRIP_PARTITION_COLUMNS, store_fragments
+
+DEMAND_CUBE_PATH = 'Final Data Files/demand_cube'
+
+# Dimensions of the cube; start_year/start_month are also the partition columns
+CUBE_DIMENSIONS = ['startstation_id', 'endstation_id', 'start_date', 'start_hour', 'holiday', 'peak_hour',
+                   'start_year', 'start_month']
+
+# Measures are kept as sums, minimums and maximums so cells from different parts can be merged
+CUBE_MEASURES = {
+    'trip_count': 'sum',
+    'duration_count': 'sum',
+    'duration_sum': 'sum',
+    'duration_sq_sum': 'sum',
+    'duration_min': 'min',
+    'duration_max': 'max',
+}
+
+# Function to aggregate processed trips into cube cells
+def aggregate_trips(bike_data):
+    """
+    Count trips and summarise duration_minutes per start station, end station, day, hour and holiday/peak flag.
+    """
+    duration = bike_data['duration_minutes'].astype('float64')
+    cells = bike_data[CUBE_DIMENSIONS].assign(duration=duration, duration_sq=duration ** 2)
+
+    cube = cells.groupby(CUBE_DIMENSIONS, observed=True, dropna=False, sort=True).agg(
+        trip_count=('duration', 'size'),
+        duration_count=('duration', 'count'),
+        duration_sum=('duration', 'sum'),
+        duration_sq_sum=('duration_sq', 'sum'),
+        duration_min=('duration', 'min'),
+        duration_max=('duration', 'max'),
+    ).reset_index()
+
+    cube['trip_count'] = cube['trip_count'].astype(np.int32)
+    cube['duration_count'] = cube['duration_count'].astype(np.int32)
+    cube['duration_min'] = cube['duration_min'].astype(np.float32)
+    cube['duration_max'] = cube['duration_max'].astype(np.float32)
+    return cube
+
+# Function to identify the contents of a trip store part
+def part_signature(fragments):
+    """
+    Return a short hash of the names, sizes and modification times of a part's fragments. A part
+    rewritten under the same key, as process_bike_data_in_chunks does on every rebuild, gets a new signature.
+    """
+    digest = hashlib.sha1()
+    for fragment in sorted(fragments):
+        status = os.stat(fragment)
+        digest.update(f"{os.sep.join(fragment.split(os.sep)[-len(TRIP_PARTITION_COLUMNS) - 1:])} "
+                      f"{status.st_size} {status.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+# Function to bring the cube in step with the trip store
+@instrument_stage()
+def update_demand_cube(store_path=TRIP_STORE_PATH, cube_path=DEMAND_CUBE_PATH):
+    """
+    Aggregate every part of the trip store that is not in the cube yet, and delete the cube cells of
+    parts that are no longer in the store. Cube fragments carry the key of the trip store part they
+    were built from and the part_signature of its fragments, so only new or rewritten parts are read.
+    Returns the number of parts aggregated.
+    """
+    trip_parts = {f"{part_key}-{part_signature(fragments)}": fragments
+                  for part_key, fragments in store_fragments(store_path).items()}
+    cube_parts = store_fragments(cube_path)
+
+    for cube_key, fragments in cube_parts.items():
+        if cube_key not in trip_parts:
+            for fragment in fragments:
+                os.remove(fragment)
+
+    added = 0
+    for cube_key, fragments in trip_parts.items():
+        if cube_key in cube_parts:
+            continue
+
+        columns = [column for column in CUBE_DIMENSIONS if column not in TRIP_PARTITION_COLUMNS] + ['duration_minutes']
+        bike_data = pd.concat([read_fragment(fragment, columns) for fragment in fragments], ignore_index=True)
+        aggregate_trips(bike_data).to_parquet(cube_path, partition_cols=TRIP_PARTITION_COLUMNS, index=False,
+                                              basename_template=f"{cube_key}-{{i}}.parquet")
+        added += 1
+
+    print(f"Demand cube updated with {added} parts.")
+    return added
+
+# Function to read one store fragment together with its partition values
+def read_fragment(fragment, columns):
+    """
+    Read the given columns of a single fragment and add start_year/start_month from its partition directories.
+    """
+    data = pd.read_parquet(fragment, columns=columns)
+    for directory in fragment.split(os.sep)[-len(TRIP_PARTITION_COLUMNS) - 1:-1]:
+        column, value = directory.split('=', 1)
+        data[column] = int(value)
+    return data
+
+# Function to check that a query bound falls on a whole hour, the grain of the cube cells
+def hour_bound(value):
+    value = pd.Timestamp(value)
+    if value != value.floor('h'):
+        raise ValueError(f"The demand cube holds hourly cells, bound {value} must be on the hour")
+    return value
+
+# Function to query the cube
+def query_demand_cube(start_stations=None, end_stations=None, start=None, end=None, holiday=None, peak_hour=None,
+                      group_by=None, cube_path=DEMAND_CUBE_PATH):
+    """
+    Return trip counts and duration statistics from the demand cube.
+
+    Parameters:
+        start_stations, end_stations (list): Only include trips between these station ids.
+        start, end (str or Timestamp): Only include trips that started on or after start and before end.
+            Both must be on the hour, e.g. '2018-06-01 08:00', as the cube counts trips per hour.
+        holiday, peak_hour (int): Only include cells with this holiday/peak_hour flag.
+        group_by (list): Dimensions to group the result by, defaults to all of CUBE_DIMENSIONS.
+
+    Only the year/month partitions overlapping start and end are read.
+
+    Returns:
+        pandas.DataFrame: One row per group with trip_count, duration_mean, duration_std, duration_min and duration_max.
+    """
+    filters = []
+    if start_stations is not None:
+        filters.append(('startstation_id', 'in', list(start_stations)))
+    if end_stations is not None:
+        filters.append(('endstation_id', 'in', list(end_stations)))
+    if holiday is not None:
+        filters.append(('holiday', '=', holiday))
+    if peak_hour is not None:
+        filters.append(('peak_hour', '=', peak_hour))
+
+    # (year, month) bounds are written as alternatives: a later year, or the same year and a later month
+    start_months, end_months = [[]], [[]]
+    if start is not None:
+        start = hour_bound(start)
+        filters.append(('start_date', '>=', start.normalize()))
+        start_months = [[('start_year', '>', start.year)],
+                        [('start_year', '=', start.year), ('start_month', '>=', start.month)]]
+    if end is not None:
+        end = hour_bound(end)
+        filters.append(('start_date', '<', end))
+        last = end - pd.Timedelta(hours=1)
+        end_months = [[('start_year', '<', last.year)],
+                      [('start_year', '=', last.year), ('start_month', '<=', last.month)]]
+    filters = [filters + start_terms + end_terms for start_terms in start_months for end_terms in end_months]
+
+    group_by = list(group_by or CUBE_DIMENSIONS)
+    bound_columns = [column for column in ('start_date', 'start_hour') if column not in group_by
+                     and (start is not None or end is not None)]
+    cube = pd.read_parquet(cube_path, columns=group_by + bound_columns + list(CUBE_MEASURES),
+                           filters=filters if filters != [[]] else None)
+
+    # Partition values come back as categoricals
+    for column in TRIP_PARTITION_COLUMNS:
+        if column in cube.columns:
+            cube[column] = cube[column].astype(int)
+
+    # The date filters only work by day, so cut the first and last day at the hour of the bounds
+    if start is not None or end is not None:
+        cell_start = cube['start_date'] + pd.to_timedelta(cube['start_hour'].astype('float64'), unit='h')
+        keep = pd.Series(True, index=cube.index)
+        if start is not None:
+            keep &= cell_start >= start
+        if end is not None:
+            keep &= cell_start < end
+        cube = cube[keep].drop(columns=bound_columns)
+
+    result = cube.groupby(group_by, observed=True, dropna=False).agg(CUBE_MEASURES).reset_index()
+    result['duration_mean'] = result['duration_sum'] / result['duration_count']
+    variance = result['duration_sq_sum'] / result['duration_count'] - result['duration_mean'] ** 2
+    result['duration_std'] = np.sqrt(variance.clip(lower=0))
+    return result.drop(columns=['duration_count', 'duration_sum', 'duration_sq_sum'])
+
+
+if __name__ == "__main__":
+    update_demand_cube()
@@ -1,114 +1,710 @@
 import os
 import re
+import glob
+import json
+import hashlib
+import time
+import shutil
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import requests
-import xmltodict
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from requests.adapters import HTTPAdapter
+
+from Stage_Instrumentation import instrument_stage, print_stage_summary
+from Date_Dimension import MISSING_KEY, WEEKDAY_DTYPE, build_date_dimension, date_hour_keys, lookup_calendar
+
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+BUCKET_URL = "https://s3-eu-west-1.amazonaws.com/cycling.data.tfl.gov.uk/"
+TRIP_FILE_PATTERN = re.compile("^usage-stats/.*(2016|2017|2018|2019).csv$")
+RAW_TRIP_DIR = "Data Files/raw_trip/"
+FILE_MANIFEST_FILE = "Data Files/file-manifest.json"
+
+TRIP_STORE_PATH = 'Final Data Files/bike_data'
+TRIP_PARTITION_COLUMNS = ['start_year', 'start_month']
+RENTAL_ID_INDEX_FILE = 'Final Data Files/rental_id_index.npz'
+PARTS_MANIFEST_FILE = 'Final Data Files/bike_data_parts.json'
+
+# Bump whenever pre_processing_bike_data changes its output, so every cached part is rebuilt
+PIPELINE_VERSION = 1
+
+TIMESTAMP_PARTS = ['day', 'month', 'year', 'hour', 'day_of_week']
+DIGIT_POSITIONS = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15]
+
+# Compact schema of the processed trip frame: small integer codes for calendar parts and flags,
+# categoricals for the repeated station names and weekdays, and float32 durations
+COMPACT_DTYPES = {
+    'duration': 'Int32',
+    'bike_id': 'Int32',
+    'endstation_id': 'Int16',
+    'endstation_name': 'category',
+    'startstation_id': 'Int16',
+    'startstation_name': 'category',
+    'start_day': 'int8',
+    'start_month': 'int8',
+    'start_year': 'int16',
+    'start_hour': 'int8',
+    'start_day_of_week': WEEKDAY_DTYPE,
+    'end_day': 'int8',
+    'end_month': 'int8',
+    'end_year': 'int16',
+    'end_hour': 'int8',
+    'end_day_of_week': WEEKDAY_DTYPE,
+    'holiday': 'int8',
+    'peak_hour': 'int8',
+    'duration_minutes': 'float32',
+}
+
+# Columns of the raw TfL usage-stats files, in file order
+TRIP_COLUMNS = ['Rental Id', 'Duration', 'Bike Id', 'End Date', 'EndStation Id', 'EndStation Name',
+                'Start Date', 'StartStation Id', 'StartStation Name']
+
+# Memory budget for the chunked pre-processing pipeline, and how many times the size of a raw chunk
+# pre_processing_bike_data needs at its peak (derived columns plus the temporary copies it makes)
+CHUNK_MEMORY_LIMIT_MB = 1024
+CHUNK_MEMORY_OVERHEAD = 4
+CHUNK_SAMPLE_ROWS = 10000
+
+# Column types for the raw TfL usage-stats files. Nullable integers keep the ids compact even
+# when a file has blank cells, and station names repeat on every trip so they are categorical.
+TRIP_DTYPES = {
+    'Rental Id': 'int64',
+    'Duration': 'Int32',
+    'Bike Id': 'Int32',
+    'EndStation Id': 'Int16',
+    'EndStation Name': 'category',
+    'StartStation Id': 'Int16',
+    'StartStation Name': 'category',
+}
+
+# Function to create a session whose keep-alive connection pool is shared by all download workers
+def create_session(pool_size=DOWNLOAD_WORKERS):
+    """
+    Create a requests Session with a connection pool large enough for pool_size concurrent workers.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 # Function to download a file from a URL and save it locally
-def download_file(url, filename):
-    if os.path.isfile(filename):
+@instrument_stage()
+def download_file(url, filename, session=None, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF,
+                  etag=None, if_none_match=None):
+    """
+    Stream a URL to filename in chunks.
+
+    The body is written to filename + '.part' and only renamed to filename once it is complete,
+    so an interrupted run never leaves a truncated file behind. A leftover .part file is resumed
+    with an HTTP Range request, and connection errors or 5xx/429 responses are retried with
+    exponential backoff.
+
+    etag is the ETag the object is expected to have. The partial file is then named after it, so a
+    .part file left by an older version of the object is discarded instead of resumed, and it is
+    sent as If-Range in case the object changes again mid-download. if_none_match is the
+    ETag of the local copy; when given, an existing file is revalidated with a conditional GET
+    instead of being skipped.
+    """
+    if os.path.isfile(filename) and if_none_match is None:
         print("File already downloaded: " + filename)
+        return filename
+
+    print("Downloading file: " + filename)
+    http = session if session is not None else requests.Session()
+    partial = filename + '.part'
+
+    headers = {}
+    if etag is not None:
+        partial = f"{filename}.{etag}.part"
+        headers['If-Range'] = f'"{etag}"'
+        for stale in glob.glob(glob.escape(filename) + '.*.part'):
+            if stale != partial:
+                os.remove(stale)
+    if if_none_match is not None and os.path.isfile(filename):
+        headers['If-None-Match'] = f'"{if_none_match}"'
+
+    for attempt in range(retries + 1):
+        try:
+            if stream_to_partial_file(http, url, partial, headers):
+                os.replace(partial, filename)
+            else:
+                print("File not modified: " + filename)
+            return filename
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, 'response', None)
+            retryable = response is None or response.status_code >= 500 or response.status_code == 429
+            if not retryable or attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"Error downloading {url}: {e}. Retrying in {wait:.1f}s.")
+            time.sleep(wait)
+
+def stream_to_partial_file(http, url, partial, headers=None):
+    """
+    Append the remaining bytes of url to the partial file, resuming from its current size.
+    Returns False if the server answered 304 Not Modified, True otherwise.
+    """
+    offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+    headers = dict(headers or {})
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
     else:
-        print("Downloading file: " + filename)
-        r = requests.get(url, allow_redirects=True)
-        open(filename, 'wb').write(r.content)
+        headers.pop('If-Range', None)
+
+    with http.get(url, headers=headers, stream=True, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 304:
+            return False
+        if offset and r.status_code == 416:
+            # The partial file already holds the whole body
+            return True
+        r.raise_for_status()
+
+        # Servers that ignore the Range header send the whole body again, so start over
+        mode = 'ab' if offset and r.status_code == 206 else 'wb'
+        expected = r.headers.get('Content-Length')
+
+        written = 0
+        with open(partial, mode) as fd:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                fd.write(chunk)
+                written += len(chunk)
+
+    if expected is not None and written != int(expected):
+        raise requests.exceptions.ConnectionError(f"Incomplete download: got {written} of {expected} bytes")
+    return True
+
+# Function to download many files concurrently over one shared connection pool
+def download_files(downloads, max_workers=DOWNLOAD_WORKERS, session=None):
+    """
+    Download a list of (url, filename) pairs with a bounded pool of worker threads.
+    An item may carry a third element, a dict of extra download_file keyword arguments.
+    Returns the list of (url, filename) pairs that failed after all retries.
+    """
+    session = session if session is not None else create_session(max_workers)
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for download in downloads:
+            url, filename = download[:2]
+            options = download[2] if len(download) > 2 else {}
+            futures[executor.submit(download_file, url, filename, session, **options)] = (url, filename)
+        for future in as_completed(futures):
+            url, filename = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error downloading file {filename}: {e}")
+                failed.append((url, filename))
+
+    return failed
+
+# Function to stream one ListBucketResult page and return its entries and pagination state
+def parse_index(source):
+    """
+    Parse an S3 ListBucketResult document from a path or file object with iterparse,
+    clearing each <Contents> element once read so memory stays flat however long the page is.
+
+    Returns (entries, next_marker) where entries is a list of dicts with key, etag, size and
+    last_modified, and next_marker is the marker for the next page, or None on the last page.
+    """
+    entries = []
+    is_truncated = False
+    next_marker = None
+    root = None
+
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end':
+            continue
+
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'Contents':
+            fields = {child.tag.rsplit('}', 1)[-1]: child.text for child in elem}
+            entries.append({
+                'key': fields['Key'],
+                'etag': (fields.get('ETag') or '').strip('"'),
+                'size': int(fields.get('Size') or 0),
+                'last_modified': fields.get('LastModified'),
+            })
+            root.clear()
+        elif tag == 'IsTruncated':
+            is_truncated = elem.text == 'true'
+        elif tag in ('NextMarker', 'NextContinuationToken'):
+            next_marker = elem.text
+
+    if not is_truncated:
+        return entries, None
+    # Listings without a delimiter carry no NextMarker; the last key is the marker
+    if next_marker is None and entries:
+        next_marker = entries[-1]['key']
+    return entries, next_marker
 
 # Function to read the index file and return a list of files to download
 def read_index(index_file):
-    with open(index_file) as fd:
-        doc = xmltodict.parse(fd.read())
+    entries, _ = parse_index(index_file)
+    return [entry['key'] for entry in entries if TRIP_FILE_PATTERN.match(entry['key'])]
+
+# Function to list every object in the bucket, following truncated listings page by page
+def fetch_index(bucket_url, session=None, pattern=TRIP_FILE_PATTERN):
+    """
+    Stream the bucket listing from bucket_url and return the entries whose key matches pattern.
+    """
+    http = session if session is not None else requests.Session()
+    entries = []
+    marker = None
+
+    while True:
+        params = {'marker': marker} if marker else {}
+        with http.get(bucket_url, params=params, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            page, marker = parse_index(r.raw)
+
+        entries.extend(entry for entry in page if pattern.match(entry['key']))
+        if marker is None:
+            return entries
+
+# Function to read the local manifest of downloaded objects
+def load_manifest(manifest_file):
+    """
+    Return the manifest mapping each bucket key to its etag, size, last_modified and local filename.
+    """
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as fd:
+        return json.load(fd)
 
-    pattern = re.compile("^usage-stats/.*(2016|2017|2018|2019).csv$")
+# Function to save the manifest atomically so a crash never leaves it half written
+def save_manifest(manifest, manifest_file):
+    temp_file = manifest_file + '.tmp'
+    with open(temp_file, 'w') as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+    os.replace(temp_file, manifest_file)
 
-    entries = [item['Key'] for item in doc['ListBucketResult']['Contents']]
-    return [f for f in entries if pattern.match(f)]
+# Function to download only the objects that are new or changed since the last run
+@instrument_stage()
+def sync_trip_files(bucket_url, raw_trip_dir, manifest_file, session=None, max_workers=DOWNLOAD_WORKERS):
+    """
+    Compare the bucket listing with the manifest and download only new or changed objects.
+    Objects whose ETag matches the manifest and whose local file exists are skipped without any
+    request; changed objects are fetched with a conditional GET against the local copy's ETag.
+    Returns the list of local files that were downloaded or revalidated.
+    """
+    session = session if session is not None else create_session(max_workers)
+    manifest = load_manifest(manifest_file)
+    entries = fetch_index(bucket_url, session)
+
+    downloads = []
+    pending = {}
+    for entry in entries:
+        local_file = os.path.join(raw_trip_dir, entry['key'].split('/')[-1].replace(' ', '_'))
+        known = manifest.get(entry['key'])
+        has_local_copy = known is not None and os.path.isfile(local_file)
+
+        if has_local_copy and known['etag'] == entry['etag']:
+            continue
+
+        options = {'etag': entry['etag']}
+        if has_local_copy:
+            options['if_none_match'] = known['etag']
+        downloads.append((bucket_url + entry['key'], local_file, options))
+        pending[local_file] = dict(entry, filename=local_file)
+
+    print(f"{len(entries)} files listed, {len(downloads)} new or changed.")
+
+    failed = download_files(downloads, max_workers=max_workers, session=session)
+    failed_files = {filename for _, filename in failed}
+    if failed:
+        print(f"{len(failed)} files could not be downloaded.")
+
+    for local_file, entry in pending.items():
+        if local_file not in failed_files:
+            manifest[entry.pop('key')] = entry
+    save_manifest(manifest, manifest_file)
+
+    return [local_file for local_file in pending if local_file not in failed_files]
     
+# Function to read a single raw trip file with compact, explicit dtypes
+def read_trip_file(filepath):
+    """
+    Read one TfL usage-stats CSV file. Returns (filepath, dataframe, error) so that it can run
+    in a worker process and report a bad file instead of raising.
+    """
+    try:
+        return filepath, pd.read_csv(filepath, dtype=TRIP_DTYPES), None
+    except Exception as e:
+        return filepath, None, e
+
+# Function to merge per-file frames column by column
+def combine_trip_frames(frames):
+    """
+    Concatenate the per-file frames one column at a time, dropping each column from the
+    per-file frames as soon as it has been merged so peak memory stays close to the size of
+    the result. Station name categoricals are merged with union_categoricals so they stay
+    categorical even though every file has its own set of categories.
+    """
+    columns = list(dict.fromkeys(column for frame in frames for column in frame.columns))
+    combined = {}
+
+    for column in columns:
+        dtype = next(frame[column].dtype for frame in frames if column in frame.columns)
+        parts = []
+        for frame in frames:
+            if column in frame.columns:
+                parts.append(frame.pop(column))
+            else:
+                # Columns only some files have are filled with NA; plain numpy ints become floats in concat
+                missing = pd.Series(np.nan, index=frame.index)
+                if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+                    missing = missing.astype(dtype)
+                parts.append(missing)
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            combined[column] = pd.Series(union_categoricals(parts, ignore_order=True))
+        else:
+            combined[column] = pd.concat(parts, ignore_index=True)
+
+    return pd.DataFrame(combined, copy=False)
+
 # Function to read the bike points file and return a dataframe
-def import_bike_data(directory):
+@instrument_stage()
+def import_bike_data(directory, workers=None):
     """
-    Read all CSV files in a directory and return them as a list of Pandas dataframes.
+    Read all CSV files in a directory and return them combined into a single Pandas dataframe.
+    Files are parsed in a pool of worker processes (workers defaults to the number of CPUs,
+    workers=1 reads them in this process). Files that cannot be read are skipped and reported.
     """
+    filepaths = [os.path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith('.csv')]
+    workers = workers or os.cpu_count() or 1
+
+    if workers > 1 and len(filepaths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(read_trip_file, filepaths))
+    else:
+        results = [read_trip_file(filepath) for filepath in filepaths]
+
     bike_data = []
-    for filename in os.listdir(directory):
-        if filename.endswith('.csv'):
-            filepath = os.path.join(directory, filename)
-            try:
-                bike_data_all = pd.read_csv(filepath)
-                bike_data.append(bike_data_all)
-                print(f"File {filename} successfully read.")
-            except Exception as e:
-                print(f"Error reading file {filename}: {e}")
-    combined_bike_data = pd.concat(bike_data, ignore_index=True)
-    
+    for filepath, bike_data_file, error in results:
+        filename = os.path.basename(filepath)
+        if error is None:
+            bike_data.append(bike_data_file)
+            print(f"File {filename} successfully read.")
+        else:
+            print(f"Error reading file {filename}: {error}")
+    del results
+
+    combined_bike_data = combine_trip_frames(bike_data)
+
     # print(combined_bike_data.columns)
     return combined_bike_data
 
-def pre_processing_bike_data(bike_data, year=None):
-    
-    #Check for duplicates and if there are any, drop them
-    if bike_data.duplicated().sum() > 0:
-        bike_data.drop_duplicates(inplace=True)
-        print("Duplicates dropped.")
+# Function to split days since 1970-01-01 into year, month and day with integer arithmetic
+def civil_from_days(days):
+    """
+    Convert an array of days since the Unix epoch into (year, month, day) arrays
+    using the proleptic Gregorian calendar, without building any datetime objects.
+    """
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year, month, day
+
+# Function to count days since 1970-01-01 from year, month and day arrays
+def days_from_civil(year, month, day):
+    """
+    Inverse of civil_from_days.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+# Function to parse 'dd/mm/YYYY HH:MM' strings straight from their digits
+def parse_fixed_width_minutes(values):
+    """
+    Parse an array of 'dd/mm/YYYY HH:MM' strings (anything after the minutes is ignored) into
+    minutes since the Unix epoch by reading the digits of each fixed-width field.
+    Returns None if any value does not have exactly that layout.
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+    encoded = np.asarray(values, dtype='S16')
+    chars = encoded.view(np.uint8).reshape(len(encoded), 16).astype(np.int64)
+    digits = chars - ord('0')
+
+    layout_ok = ((chars[:, [2, 5]] == ord('/')).all(axis=1) & (chars[:, 10] == ord(' ')) & (chars[:, 13] == ord(':'))
+                 & ((digits[:, DIGIT_POSITIONS] >= 0) & (digits[:, DIGIT_POSITIONS] <= 9)).all(axis=1))
+    if not layout_ok.all():
+        return None
+
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 3] * 10 + digits[:, 4]
+    year = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+    hour = digits[:, 11] * 10 + digits[:, 12]
+    minute = digits[:, 14] * 10 + digits[:, 15]
+
+    days = days_from_civil(year, month, day)
+    # Reject impossible dates such as 31/02, which would otherwise roll over into the next month
+    if (month < 1).any() or (month > 12).any() or (hour > 23).any() or (minute > 59).any() \
+            or (day < 1).any() or not np.array_equal(civil_from_days(days)[2], day):
+        return None
+
+    return days * 1440 + hour * 60 + minute
+
+# Function to parse TfL trip timestamp columns once per distinct value
+def parse_trip_timestamps(*columns):
+    """
+    Parse 'dd/mm/YYYY HH:MM' timestamp columns (anything after the minutes is ignored).
+
+    Trip times are truncated to the minute, so there are far fewer distinct values than rows.
+    Each column is factorized and each distinct string parsed once (straight from its digits
+    when it has the usual fixed-width layout). The parsed minutes of all columns are then
+    factorized together, so the date parts are derived with integer arithmetic once per distinct
+    minute and shared by every column. Every row then just picks its values out by code.
+
+    Returns one dict per column with the timestamp, date and TIMESTAMP_PARTS arrays.
+    """
+    factorized = []
+    for column in columns:
+        codes, column_uniques = pd.factorize(column)
+        column_uniques = np.asarray(column_uniques, dtype=object)
+
+        column_minutes = parse_fixed_width_minutes(column_uniques)
+        if column_minutes is None:
+            timestamps = pd.to_datetime(pd.Series(column_uniques).str.slice(0, 16), format='%d/%m/%Y %H:%M')
+            column_minutes = timestamps.to_numpy().astype('datetime64[m]').astype(np.int64)
+        factorized.append((codes, column_minutes))
+
+    # Factorize the parsed minutes of all columns together so the columns share codes
+    shared_codes, minutes = pd.factorize(np.concatenate([column_minutes for _, column_minutes in factorized]))
+
+    timestamps = minutes.astype('datetime64[m]').astype('datetime64[us]')
+    days = minutes // 1440
+    year, month, day = civil_from_days(days)
+
+    parts = {
+        'timestamp': timestamps,
+        'date': days.astype('datetime64[D]'),
+        'day': day.astype(np.int8),
+        'month': month.astype(np.int8),
+        'year': year.astype(np.int16),
+        'hour': (minutes % 1440 // 60).astype(np.int8),
+    }
+    weekday_codes = ((days + 3) % 7).astype(np.int8)
+
+    results = []
+    offset = 0
+    for codes, column_minutes in factorized:
+        missing = codes == -1
+        if len(column_minutes):
+            codes = shared_codes[offset:offset + len(column_minutes)][codes]
+            codes[missing] = -1
+        offset += len(column_minutes)
+
+        if missing.any():
+            # Missing timestamps take the NaT/NaN value appended to the end of every array
+            result = {name: np.append(values.astype(float) if values.dtype.kind == 'i' else values,
+                                      np.datetime64('NaT') if values.dtype.kind == 'M' else np.nan)[codes]
+                      for name, values in parts.items()}
+            weekday = np.append(weekday_codes, -1)[codes]
+        else:
+            result = {name: values[codes] for name, values in parts.items()}
+            weekday = weekday_codes[codes]
+
+        result['day_of_week'] = pd.Categorical.from_codes(weekday, dtype=WEEKDAY_DTYPE)
+        results.append(result)
+
+    return results
+
+# Function to find the calendar years spanned by arrays of date/hour keys
+def year_range(*keys):
+    """
+    Return (first_year, last_year) covered by the non-missing keys, or (1970, 1970) if there are none.
+    """
+    valid = np.concatenate([key[key != MISSING_KEY] for key in keys])
+    if not len(valid):
+        return 1970, 1970
+    years = np.array([valid.min(), valid.max()]).astype('datetime64[h]').astype('datetime64[Y]').astype(int) + 1970
+    return int(years[0]), int(years[1])
+
+# Function to measure how much memory a dataframe takes per row
+def bytes_per_row(df):
+    return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+# Function to convert the processed trip columns to the compact schema
+def compact_bike_data(bike_data):
+    """
+    Convert the processed trip columns that are present to COMPACT_DTYPES and print the bytes per row
+    before and after. Integer columns holding missing values use the nullable integer of the same size.
+    """
+    before = bytes_per_row(bike_data)
+
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in bike_data.columns or bike_data[column].dtype == dtype:
+            continue
+        if isinstance(dtype, str) and dtype.startswith('int') and bike_data[column].isna().any():
+            dtype = dtype.capitalize()
+        bike_data[column] = bike_data[column].astype(dtype)
+
+    print(f"Compact schema applied: {before:.1f} -> {bytes_per_row(bike_data):.1f} bytes per row.")
+    return bike_data
+
+# Set of Rental Ids already processed, kept as a bitmap that persists across runs
+class RentalIdIndex:
+    """
+    Bitmap of every Rental Id that has been processed. Rental Ids are dense sequential integers, so a
+    bit per id from the smallest id seen is far more compact than storing the ids themselves. It is held
+    as a bool array in memory and saved bit-packed to path, so newly downloaded files can be deduplicated
+    against the whole history without reloading it. path=None keeps the index in memory only.
+    """
+    def __init__(self, path=RENTAL_ID_INDEX_FILE):
+        self.path = path
+        self.base = 0
+        self.seen = np.zeros(0, dtype=bool)
+
+        if path is not None and os.path.isfile(path):
+            with np.load(path) as saved:
+                self.base = int(saved['base'])
+                self.seen = np.unpackbits(saved['bits'], count=int(saved['length'])).astype(bool)
+
+    def __len__(self):
+        return int(self.seen.sum())
+
+    def contains(self, ids):
+        """
+        Return a bool array telling which of ids are in the index.
+        """
+        offsets = np.asarray(ids, dtype=np.int64) - self.base
+        in_range = (offsets >= 0) & (offsets < len(self.seen))
+        found = np.zeros(len(offsets), dtype=bool)
+        found[in_range] = self.seen[offsets[in_range]]
+        return found
+
+    def add(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids):
+            self.grow(ids.min(), ids.max())
+            self.seen[ids - self.base] = True
+
+    def discard(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[self.contains(ids)]
+        self.seen[ids - self.base] = False
+
+    def grow(self, low, high):
+        """
+        Extend the bitmap so it covers ids low to high.
+        """
+        if not len(self.seen):
+            self.base = int(low)
+            self.seen = np.zeros(int(high - low) + 1, dtype=bool)
+            return
+        new_base = min(self.base, int(low))
+        new_length = max(self.base + len(self.seen), int(high) + 1) - new_base
+        if new_base != self.base or new_length != len(self.seen):
+            seen = np.zeros(new_length, dtype=bool)
+            seen[self.base - new_base:self.base - new_base + len(self.seen)] = self.seen
+            self.base, self.seen = new_base, seen
+
+    def save(self, path=None):
+        """
+        Save the bitmap atomically to path (defaults to the path it was loaded from).
+        """
+        path = path or self.path
+        temp_file = path + '.tmp.npz'
+        np.savez(temp_file, base=self.base, length=len(self.seen), bits=np.packbits(self.seen))
+        os.replace(temp_file, path)
+
+# Function to drop repeated rentals by Rental Id
+def drop_duplicate_rentals(bike_data, rental_id_index=None):
+    """
+    Drop rows whose Rental Id already appeared earlier in bike_data or, when a RentalIdIndex is given,
+    in a previous run. Only the Rental Id column is hashed, not whole rows.
+    """
+    rental_ids = bike_data['Rental Id'].to_numpy()
+    keep = ~pd.Series(rental_ids).duplicated().to_numpy()
+    if rental_id_index is not None:
+        keep &= ~rental_id_index.contains(rental_ids)
+
+    duplicates = len(keep) - int(keep.sum())
+    if duplicates:
+        bike_data = bike_data[keep]
+        print("Duplicates dropped.", duplicates)
     else:
         print("No duplicates.")
+    return bike_data
+
+@instrument_stage()
+def pre_processing_bike_data(bike_data, year=None, compact=True, rental_id_index=None):
+    """
+    Clean the raw trip data and add the date, holiday, peak hour and duration columns.
+    When a RentalIdIndex is given, rentals it already holds are dropped and the rentals kept are added
+    to it; saving the index once the output has been stored is up to the caller.
+    """
+    
+    #Check for duplicates and if there are any, drop them
+    bike_data = drop_duplicate_rentals(bike_data, rental_id_index)
         
     #Change column names
     bike_data.columns = bike_data.columns.str.lower().str.replace(' ', '_')
     
     print("Column names changed.", bike_data.columns)
     
-    bike_data['start_date'] = bike_data['start_date'].str.slice(0, 16)  
-    bike_data['end_date'] = bike_data['start_date'].str.slice(0, 16)  
-    
-    # Change the data type of the start_date and end_date columns to datetime
-    bike_data['start_timestamp'] = pd.to_datetime(bike_data['start_date'],format='%d/%m/%Y %H:%M')
-    bike_data['end_timestamp'] = pd.to_datetime(bike_data['end_date'],format='%d/%m/%Y %H:%M')
-    
+    # Parse the start_date and end_date columns once per distinct minute and derive the date parts from them
+    start, end = parse_trip_timestamps(bike_data['start_date'], bike_data['end_date'])
+
+    bike_data['start_timestamp'] = start['timestamp']
+    bike_data['end_timestamp'] = end['timestamp']
+
     #get the start_date and end_date columns from the start_timestamp and end_timestamp columns
-    bike_data['start_date'] = bike_data['start_timestamp'].dt.date
-    bike_data['end_date'] = bike_data['end_timestamp'].dt.date
-    
-    
+    bike_data['start_date'] = start['date']
+    bike_data['end_date'] = end['date']
+
     # get the day, month, year, hour, and day of the week from the start_timestamp column
-    bike_data['start_day'] = bike_data['start_timestamp'].dt.day
-    bike_data['start_month'] = bike_data['start_timestamp'].dt.month
-    bike_data['start_year'] = bike_data['start_timestamp'].dt.year
-    bike_data['start_hour'] = bike_data['start_timestamp'].dt.hour
-    bike_data['start_day_of_week'] = bike_data['start_timestamp'].dt.day_name()
-    
+    for part in TIMESTAMP_PARTS:
+        bike_data['start_' + part] = start[part]
+
     # get the day, month, year, hour, and day of the week from the end_timestamp column
-    bike_data['end_day'] = bike_data['end_timestamp'].dt.day
-    bike_data['end_month'] = bike_data['end_timestamp'].dt.month
-    bike_data['end_year'] = bike_data['end_timestamp'].dt.year
-    bike_data['end_hour'] = bike_data['end_timestamp'].dt.hour
-    bike_data['end_day_of_week'] = bike_data['end_timestamp'].dt.day_name()
+    for part in TIMESTAMP_PARTS:
+        bike_data['end_' + part] = end[part]
     
     print("Date and time columns created.")
-    
-    bike_data['start_date'] = pd.to_datetime(bike_data['start_date'])
 
-    # Set Holiday to 1 for specified dates
-    holidays = [
-        '2016-12-27', '2016-12-26', '2016-12-25', '2016-08-29', '2016-05-30',
-        '2016-05-02', '2016-03-28', '2016-03-25', '2016-01-01',
-        '2017-12-26', '2017-12-25', '2017-08-28', '2017-05-29',
-        '2017-05-01', '2017-04-17', '2017-04-14', '2017-01-02',
-        '2018-12-26', '2018-12-25', '2018-08-27', '2018-05-28',
-        '2018-05-07', '2018-04-02', '2018-03-30', '2018-01-01',
-        '2019-12-26', '2019-12-25', '2019-08-26', '2019-05-27',
-        '2019-05-06', '2019-04-22', '2019-04-19', '2019-01-01',
-    ]
-    
-    # set bank_holiday to 1 for all rows where the start_date is in the bank_holidays list
-    bike_data['holiday'] = bike_data['start_date'].isin(holidays).astype(int)
+    # Look the holiday and peak hour flags up in the date dimension by integer date/hour key
+    start_keys = date_hour_keys(bike_data['start_timestamp'])
+    end_keys = date_hour_keys(bike_data['end_timestamp'])
+    date_dimension = build_date_dimension(*year_range(start_keys, end_keys))
+
+    start = lookup_calendar(start_keys, date_dimension, ['holiday', 'peak_hour', 'weekday'])
+    end = lookup_calendar(end_keys, date_dimension, ['peak_hour_of_day'])
+
+    # set holiday to 1 for all rows where the start_date is a bank holiday
+    bike_data['holiday'] = start['holiday']
     
     print("Holiday column created.", bike_data['holiday'].nunique())
 
-    # set peak_hour to 1 for hours between between 06:30 and 09:30, and between 16:00 and 19:00 from Monday to Friday (not on public holidays)
-    bike_data['peak_hour'] = ((bike_data['start_hour'].between(6, 9) | bike_data['end_hour'].between(6, 9) |
-                               bike_data['start_hour'].between(16, 19) | bike_data['end_hour'].between(16, 19)) &
-                              (bike_data['start_day_of_week'].isin(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']))).astype(int)
+    # set peak_hour to 1 when the trip starts or ends in a peak hour (06:00-09:59 or 16:00-19:59) and starts Monday to Friday
+    bike_data['peak_hour'] = start['peak_hour'] | (end['peak_hour_of_day'] & start['weekday'])
     
     print("Peak hour columns created.", bike_data['peak_hour'].nunique())
     
@@ -121,49 +717,273 @@ def pre_processing_bike_data(bike_data, year=None):
         bike_data = bike_data[bike_data['start_year'] == year]
         
     print("Dataframe filtered by year of: ", year)
+
+    if rental_id_index is not None:
+        rental_id_index.add(bike_data['rental_id'].to_numpy())
+
+    if compact:
+        bike_data = compact_bike_data(bike_data)
     
     print( "Data pre-processing complete. With the following columns: \n", bike_data.columns)
     
     
     return bike_data
 
-# Function to save the bike data to a CSV file
-def save_bike_data(bike_data):
+# Function to work out how many rows per chunk fit in the memory budget
+def estimate_chunk_rows(filepath, max_memory_mb=CHUNK_MEMORY_LIMIT_MB):
+    """
+    Measure the in-memory size of a sample of filepath and return the number of rows per chunk
+    that keeps pre-processing within max_memory_mb.
+    """
+    sample = pd.read_csv(filepath, dtype=TRIP_DTYPES, nrows=CHUNK_SAMPLE_ROWS)
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    return max(1000, int(max_memory_mb * 2**20 / (bytes_per_row * CHUNK_MEMORY_OVERHEAD)))
+
+# Function to pre-process the raw trip files chunk by chunk into the trip store
+@instrument_stage()
+def process_bike_data_in_chunks(directory, path=TRIP_STORE_PATH, max_memory_mb=CHUNK_MEMORY_LIMIT_MB, year=None,
+                                rental_id_index_file=RENTAL_ID_INDEX_FILE):
+    """
+    Stream every CSV file in directory through pre_processing_bike_data in chunks sized to stay within
+    max_memory_mb, appending each processed chunk to a new Parquet trip store that replaces the one at
+    path when all files are done. Files that cannot be read are skipped and reported.
+
+    Duplicates across chunks and files are dropped by Rental Id with a RentalIdIndex built from
+    scratch for the new store, which is saved to rental_id_index_file alongside it.
+    """
+    filepaths = [os.path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith('.csv')]
+    rental_id_index = RentalIdIndex(path=None)
+
+    temp_path = path.rstrip('/') + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+
+    rows_written = 0
+    for file_number, filepath in enumerate(filepaths):
+        filename = os.path.basename(filepath)
+        file_rental_ids = []
+        try:
+            chunk_rows = estimate_chunk_rows(filepath, max_memory_mb)
+            for chunk_number, chunk in enumerate(pd.read_csv(filepath, dtype=TRIP_DTYPES, chunksize=chunk_rows)):
+                # Give every chunk the same columns so all fragments of the store share one schema
+                chunk = chunk.reindex(columns=TRIP_COLUMNS).astype(TRIP_DTYPES)
+                chunk = pre_processing_bike_data(chunk, year, rental_id_index=rental_id_index)
+                file_rental_ids.append(chunk['rental_id'].to_numpy())
+
+                if len(chunk):
+                    chunk.to_parquet(temp_path, partition_cols=TRIP_PARTITION_COLUMNS, index=False,
+                                     basename_template=f"file{file_number}-chunk{chunk_number}-{{i}}.parquet")
+            rows_written += sum(len(rental_ids) for rental_ids in file_rental_ids)
+            print(f"File {filename} successfully processed.")
+        except Exception as e:
+            # Drop the chunks already written for this file so it is skipped as a whole
+            for fragment in glob.glob(os.path.join(glob.escape(temp_path), '**', f"file{file_number}-*.parquet"), recursive=True):
+                os.remove(fragment)
+            for rental_ids in file_rental_ids:
+                rental_id_index.discard(rental_ids)
+            print(f"Error processing file {filename}: {e}")
+
+    if rows_written:
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        rental_id_index.save(rental_id_index_file)
+    print(f"{rows_written} rows of bike data saved to Parquet store.")
+
+# Function to hash the contents of a file
+def file_content_hash(filepath, block_size=DOWNLOAD_CHUNK_SIZE * 16):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fd:
+        for block in iter(lambda: fd.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to hash the raw trip files, reusing the hashes of files that have not changed
+def raw_file_hashes(directory, manifest):
     """
-    Save the bike data to a CSV file.
+    Return a dict mapping each CSV file in directory to its content hash, size and mtime_ns. A file
+    whose size and modification time match its parts manifest entry is not read again.
     """
-    bike_data.to_csv('Final Data Files/bike_data_2016_2019.csv', index=False)
-    print("Bike data saved to CSV file.")
+    files = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.csv'):
+            continue
+        status = os.stat(os.path.join(directory, filename))
+        entry = manifest.get(filename, {})
+        if entry.get('hash') and entry.get('size') == status.st_size and entry.get('mtime_ns') == status.st_mtime_ns:
+            content_hash = entry['hash']
+        else:
+            content_hash = file_content_hash(os.path.join(directory, filename))
+        files[filename] = {'hash': content_hash, 'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+    return files
+
+# Function to list the fragments of the trip store by the part they belong to
+def store_fragments(path=TRIP_STORE_PATH):
+    """
+    Return a dict mapping each part key to the list of its fragment files in the trip store.
+    Fragments are named '<part key>-<i>.parquet'.
+    """
+    fragments = {}
+    for fragment in glob.glob(os.path.join(glob.escape(path), '**', '*.parquet'), recursive=True):
+        part_key = os.path.basename(fragment).rsplit('-', 1)[0]
+        fragments.setdefault(part_key, []).append(fragment)
+    return fragments
+
+# Function to update the trip store with only the raw files that are new or changed
+@instrument_stage()
+def process_bike_data_incrementally(directory, path=TRIP_STORE_PATH, parts_manifest_file=PARTS_MANIFEST_FILE,
+                                    rental_id_index_file=RENTAL_ID_INDEX_FILE):
+    """
+    Keep the trip store in step with the raw files in directory, processing only what changed.
+
+    Each raw file's processed rows are cached in the store as fragments named after the file's
+    content hash and PIPELINE_VERSION, and the parts manifest records which part each file produced.
+    A file whose part is already in the store is skipped. Fragments of changed or removed files, and
+    any fragment the manifest does not know about, are deleted and their Rental Ids released from the
+    index, so a re-issued file is not mistaken for a duplicate of its old version. New parts are
+    deduplicated against the Rental Id index of everything already in the store.
+
+    The manifest also records how many rows of each part were dropped as already in the index. Those
+    rows may only be in the store through an earlier part, so when a part is invalidated every part
+    processed after it that had rows dropped is processed again as well.
+
+    A file that cannot be read or processed is skipped and reported, and the Rental Ids it added are
+    released again. Returns the list of part keys that were added.
+    """
+    manifest = load_manifest(parts_manifest_file)
+    files = raw_file_hashes(directory, manifest)
+    current = {filename: f"{file['hash']}-v{PIPELINE_VERSION}" for filename, file in files.items()}
+
+    # A part is only reused if the file is unchanged and its fragments are still in the store
+    fragments_by_part = store_fragments(path)
+    retained = {filename: dict(entry, **files[filename]) for filename, entry in manifest.items()
+                if current.get(filename) == entry['key'] and (entry['key'] in fragments_by_part or entry['rows'] == 0)}
+
+    # Walk the parts in the order they were processed. Parts without a sequence or dropped count come
+    # from an older manifest, which processed files in name order and is treated as having dropped rows
+    invalidated = False
+    for filename, entry in sorted(manifest.items(), key=lambda item: (item[1].get('sequence', -1), item[0])):
+        if filename not in retained:
+            invalidated = True
+        elif invalidated and entry.get('dropped') != 0:
+            del retained[filename]
+    retained_keys = {entry['key'] for entry in retained.values()}
+
+    # Remove every fragment that does not belong to a retained part, releasing its Rental Ids first
+    rebuild_index = not os.path.isfile(rental_id_index_file)
+    rental_id_index = RentalIdIndex(rental_id_index_file)
+    for part_key, fragments in fragments_by_part.items():
+        if part_key in retained_keys:
+            if rebuild_index:
+                for fragment in fragments:
+                    rental_id_index.add(pd.read_parquet(fragment, columns=['rental_id'])['rental_id'].to_numpy())
+            continue
+        for fragment in fragments:
+            rental_id_index.discard(pd.read_parquet(fragment, columns=['rental_id'])['rental_id'].to_numpy())
+            os.remove(fragment)
+
+    print(f"{len(retained)} files unchanged, {len(current) - len(retained)} new or changed.")
+
+    added = []
+    sequence = max([entry.get('sequence', -1) for entry in retained.values()], default=-1)
+    for filename, part_key in current.items():
+        if filename in retained:
+            continue
+
+        _, bike_data, error = read_trip_file(os.path.join(directory, filename))
+        if error is not None:
+            print(f"Error reading file {filename}: {error}")
+            continue
+
+        new_ids = None
+        try:
+            bike_data = bike_data.reindex(columns=TRIP_COLUMNS).astype(TRIP_DTYPES)
+            rental_ids = bike_data['Rental Id'].to_numpy()
+            known = rental_id_index.contains(rental_ids)
+            dropped, new_ids = int(known.sum()), rental_ids[~known]
+
+            bike_data = pre_processing_bike_data(bike_data, rental_id_index=rental_id_index)
+            if len(bike_data):
+                bike_data.to_parquet(path, partition_cols=TRIP_PARTITION_COLUMNS, index=False,
+                                     basename_template=f"{part_key}-{{i}}.parquet")
+        except Exception as e:
+            # Drop what was written for this file so it is skipped as a whole
+            for fragment in store_fragments(path).get(part_key, []):
+                os.remove(fragment)
+            if new_ids is not None:
+                rental_id_index.discard(new_ids)
+            print(f"Error processing file {filename}: {e}")
+            continue
+
+        sequence += 1
+        retained[filename] = dict({'key': part_key, 'rows': len(bike_data), 'dropped': dropped, 'sequence': sequence},
+                                  **files[filename])
+        added.append(part_key)
+        print(f"File {filename} successfully processed.")
+
+    # The index is saved first: parts it holds that the manifest does not know are removed on the next run
+    rental_id_index.save(rental_id_index_file)
+    save_manifest(retained, parts_manifest_file)
+    print(f"Bike data store updated with {len(added)} parts.")
+    return added
+
+# Function to save the bike data to the partitioned Parquet trip store
+@instrument_stage()
+def save_bike_data(bike_data, path=TRIP_STORE_PATH):
+    """
+    Save the bike data to a Parquet dataset partitioned by start_year/start_month.
+    The store is written next to the old one and swapped in, so readers never see a half-written store.
+    """
+    temp_path = path.rstrip('/') + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    bike_data.to_parquet(temp_path, partition_cols=TRIP_PARTITION_COLUMNS, index=False)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+    print("Bike data saved to Parquet store.")
     
-def read_bike_data():
+@instrument_stage()
+def read_bike_data(columns=None, year=None, months=None, path=TRIP_STORE_PATH, compact=True):
     """
-    Read the bike data from a CSV file.
+    Read the bike data from the Parquet trip store.
+
+    Parameters:
+        columns (list): Columns to load. None loads every column.
+        year (int or list): Only load trips that started in this year (or these years).
+        months (list): Only load trips that started in these months.
+        compact (bool): Convert the loaded columns to the compact schema.
+
+    Only the partitions matching year and months are opened, and only the requested columns are read from them.
     """
-    bike_data = pd.read_csv('Final Data Files/bike_data_2016_2019.csv')
-    print("Bike data read from CSV file.")
+    filters = []
+    if year is not None:
+        filters.append(('start_year', 'in', [year] if np.isscalar(year) else list(year)))
+    if months is not None:
+        filters.append(('start_month', 'in', list(months)))
+
+    bike_data = pd.read_parquet(path, columns=columns, filters=filters or None)
+
+    # Partition values come back as categoricals, turn them back into the ints they were saved as
+    for column in TRIP_PARTITION_COLUMNS:
+        if column in bike_data.columns:
+            bike_data[column] = bike_data[column].astype(int)
+
+    if compact:
+        bike_data = compact_bike_data(bike_data)
+
+    print("Bike data read from Parquet store.")
     return bike_data
     
 
 if __name__ == "__main__":
-    BUCKET_URL = "https://s3-eu-west-1.amazonaws.com/cycling.data.tfl.gov.uk/"
-    INDEX_FILE = "Data Files/file-index.xml"
-    RAW_TRIP_DIR = "Data Files/raw_trip/"
-
     if not os.path.exists(RAW_TRIP_DIR):
         os.makedirs(RAW_TRIP_DIR)
 
-    download_file(BUCKET_URL, INDEX_FILE)
-
-    files = read_index(INDEX_FILE)
+    sync_trip_files(BUCKET_URL, RAW_TRIP_DIR, FILE_MANIFEST_FILE)
+    
+    # Only the raw files that are new or changed since the last run are processed
+    process_bike_data_incrementally(RAW_TRIP_DIR)
 
-    for file in files:
-        local_file = RAW_TRIP_DIR + file.split('/')[-1].replace(' ', '_')
-        url = BUCKET_URL + file
+    # Aggregate the new parts into the station x hour demand cube
+    from Demand_Cube import update_demand_cube
+    update_demand_cube()
 
-        download_file(url, local_file)
-    
-    bike_data = import_bike_data('Data Files/raw_trip')
-    
-    bike_data = pre_processing_bike_data(bike_data)
-    
-    save_bike_data(bike_data)
\ No newline at end of file
+    print_stage_summary()
\ No newline at end of file
@@ -1,11 +1,37 @@
+import os
+import sys
+import asyncio
+import uuid
+
+import aiohttp
 import requests
+import numpy as np
 import pandas as pd
 
+from Stage_Instrumentation import instrument_stage, print_stage_summary
+
+BIKE_POINT_URL = "https://api.tfl.gov.uk/BikePoint/"
+OCCUPANCY_STORE_PATH = './Final Data Files/bike_point_occupancy'
+
+POLL_INTERVAL = 60
+POLL_TIMEOUT = 30
+POLL_FLUSH_EVERY = 10
+
+# Occupancy values in additionalProperties and the columns they are stored in
+OCCUPANCY_FIELDS = {
+    'NbBikes': 'number_of_bikes',
+    'NbEmptyDocks': 'number_empty_docks',
+    'NbDocks': 'number_of_docks',
+    'NbEBikes': 'number_ebikes',
+    'NbStandardBikes': 'number_standard_bikes',
+}
+
+@instrument_stage()
 def get_bike_points():
     
     # Get the bike points data from the TFL API
     try:
-        response = requests.get("https://api.tfl.gov.uk/BikePoint/")
+        response = requests.get(BIKE_POINT_URL)
         
         response.raise_for_status()
         
@@ -30,16 +56,9 @@ def get_bike_points():
             
             #Add additional properties to the dataframe
             for additionalProperty in x['additionalProperties']:
-                if additionalProperty['key'] == 'NbBikes':
-                    x['number_of_bikes'] = additionalProperty['value']
-                elif additionalProperty['key'] == 'NbEmptyDocks':
-                    x['number_empty_docks'] = additionalProperty['value']
-                elif additionalProperty['key'] == 'NbDocks':
-                    x['number_of_docks'] = additionalProperty['value']
-                elif additionalProperty['key'] == 'NbEBikes':
-                    x['number_ebikes'] = additionalProperty['value']
-                elif additionalProperty['key'] == 'NbStandardBikes':
-                    x['number_standard_bikes'] = additionalProperty['value']
+                field = OCCUPANCY_FIELDS.get(additionalProperty['key'])
+                if field is not None:
+                    x[field] = additionalProperty['value']
             
             x.pop('additionalProperties')
                     
@@ -54,6 +73,7 @@ def get_bike_points():
         return None
     
 # Function that pre-processes the bike_points.csv file
+@instrument_stage()
 def pre_process_bike_points(bike_points):
     """
     Pre-processes the bike_points.csv file.
@@ -78,6 +98,7 @@ def read_bike_points():
     return pd.read_csv('./Final Data Files/bike_points.csv')
     
 # Function to save the bike points data to Final Data Files
+@instrument_stage()
 def save_bike_points(bike_points):
     """
     Save the bike points data to a CSV file.
@@ -87,9 +108,163 @@ def save_bike_points(bike_points):
     
     
 
+# Function to read one occupancy count, -1 when it is missing or not a count
+def occupancy_value(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return -1
+    return value if 0 <= value <= np.iinfo(np.int16).max else -1
+
+# Function to parse the occupancy values out of a BikePoint payload
+def parse_occupancy(payload):
+    """
+    Return a DataFrame with bike_station_id and one int16 column per OCCUPANCY_FIELDS entry, -1 where a value
+    is missing or cannot be parsed. Raises ValueError when the payload is not a list of bike points.
+    """
+    if not isinstance(payload, list):
+        raise ValueError(f"expected a list of bike points, got {type(payload).__name__}")
+
+    station_ids = np.empty(len(payload), dtype=np.int16)
+    values = np.full((len(payload), len(OCCUPANCY_FIELDS)), -1, dtype=np.int16)
+    positions = {key: position for position, key in enumerate(OCCUPANCY_FIELDS)}
+
+    for row, bike_point in enumerate(payload):
+        station_ids[row] = int(bike_point['id'].rsplit('_', 1)[-1])
+        for additionalProperty in bike_point['additionalProperties']:
+            position = positions.get(additionalProperty['key'])
+            if position is not None:
+                values[row, position] = occupancy_value(additionalProperty.get('value'))
+
+    occupancy = pd.DataFrame(values, columns=list(OCCUPANCY_FIELDS.values()))
+    occupancy.insert(0, 'bike_station_id', station_ids)
+    return occupancy
+
+# Class that keeps the occupancy time series and appends only the values that changed
+class OccupancyStore:
+    """
+    Append-only occupancy time series stored as Parquet fragments in path.
+
+    A row (timestamp, bike_station_id, occupancy columns) is only kept when a station's values differ
+    from the last ones recorded for it. Rows are buffered and written as one new fragment per flush,
+    so existing fragments are never rewritten.
+    """
+    def __init__(self, path=OCCUPANCY_STORE_PATH):
+        self.path = path
+        self.buffer = []
+        self.last = pd.DataFrame(columns=list(OCCUPANCY_FIELDS.values()), dtype=np.int16)
+
+        # Start from the last recorded values, so a restart does not duplicate the current state
+        if os.path.isdir(path) and os.listdir(path):
+            history = read_occupancy(path)
+            self.last = history.groupby('bike_station_id')[list(OCCUPANCY_FIELDS.values())].last()
+
+    def update(self, occupancy, timestamp):
+        """
+        Buffer the stations of a parsed snapshot whose values changed, and return how many there were.
+        """
+        occupancy = occupancy.drop_duplicates('bike_station_id').set_index('bike_station_id')
+        previous = self.last.reindex(occupancy.index, fill_value=-2)
+        changed = occupancy[(occupancy.to_numpy() != previous.to_numpy()).any(axis=1)]
+
+        if len(changed) > 0:
+            rows = changed.reset_index()
+            rows['bike_station_id'] = rows['bike_station_id'].astype(np.int16)
+            rows.insert(0, 'timestamp', pd.Timestamp(timestamp).as_unit('s'))
+            self.buffer.append(rows)
+            self.last = pd.concat([self.last.drop(changed.index, errors='ignore'), changed]).astype(np.int16)
+        return len(changed)
+
+    def flush(self):
+        """
+        Write the buffered rows as a new fragment and return the number of rows written.
+        """
+        if not self.buffer:
+            return 0
+        rows = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+
+        os.makedirs(self.path, exist_ok=True)
+        first = rows['timestamp'].iloc[0].strftime('%Y%m%dT%H%M%S')
+        last = rows['timestamp'].iloc[-1].strftime('%Y%m%dT%H%M%S')
+        fragment = os.path.join(self.path, f"occupancy-{first}-{last}-{uuid.uuid4().hex[:8]}.parquet")
+        rows.to_parquet(f"{fragment}.tmp", index=False)
+        os.replace(f"{fragment}.tmp", fragment)
+        return len(rows)
+
+# Function to read the occupancy time series
+def read_occupancy(path=OCCUPANCY_STORE_PATH):
+    """
+    Read every occupancy fragment, sorted by timestamp and station.
+    """
+    occupancy = pd.read_parquet(path)
+    return occupancy.sort_values(['timestamp', 'bike_station_id'], ignore_index=True)
+
+# Function to fetch one BikePoint snapshot with a shared client session
+async def fetch_bike_points(session, url=BIKE_POINT_URL):
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            payload = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+        print(f"Failed to fetch bike points: {type(err).__name__} {err}")
+        return None
+    if not isinstance(payload, list):
+        print(f"Failed to fetch bike points: expected a list of bike points, got {type(payload).__name__}")
+        return None
+    return payload
+
+# Function that polls the BikePoint API on an interval and records occupancy changes
+async def poll_bike_points(url=BIKE_POINT_URL, path=OCCUPANCY_STORE_PATH, interval=POLL_INTERVAL,
+                           flush_every=POLL_FLUSH_EVERY, max_polls=None):
+    """
+    Fetch a snapshot every interval seconds and append the changed occupancy values to the store.
+
+    All requests go through one pooled aiohttp session. Snapshots that fail or are malformed are skipped. Buffered rows
+    are flushed every flush_every polls and when polling stops. max_polls limits the number of polls,
+    None polls until cancelled. Returns the store.
+    """
+    store = OccupancyStore(path)
+    timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT)
+    loop = asyncio.get_running_loop()
+    polls = 0
+
+    try:
+        async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=1)) as session:
+            while max_polls is None or polls < max_polls:
+                started = loop.time()
+                payload = await fetch_bike_points(session, url)
+                polls += 1
+
+                if payload is not None:
+                    try:
+                        occupancy = parse_occupancy(payload)
+                    except (ValueError, KeyError, TypeError, AttributeError) as err:
+                        print(f"Skipping malformed bike points snapshot: {type(err).__name__} {err}")
+                    else:
+                        changed = store.update(occupancy, pd.Timestamp.now(tz='UTC').tz_localize(None))
+                        print(f"Poll {polls}: {changed} stations changed.")
+                if polls % flush_every == 0:
+                    store.flush()
+
+                if max_polls is None or polls < max_polls:
+                    await asyncio.sleep(max(0, interval - (loop.time() - started)))
+    finally:
+        store.flush()
+
+    return store
+
+
 if __name__ == "__main__":
+    # Run as a long-running occupancy poller with --poll
+    if '--poll' in sys.argv:
+        asyncio.run(poll_bike_points())
+        sys.exit(0)
+
     bike_points = get_bike_points()
     
     bike_points = pre_process_bike_points(bike_points)
     
-    save_bike_points(bike_points)
\ No newline at end of file
+    save_bike_points(bike_points)
+
+    print_stage_summary()
\ No newline at end of file
@@ -2,8 +2,43 @@ import pandas as pd
 import numpy as np
 import os
 import re
+import hashlib
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
+from Stage_Instrumentation import instrument_stage, print_stage_summary
+
+DEMOGRAPHICS_CACHE_DIR = "Final Data Files/demographics_cache"
+EXCEL_CACHE_DIR = "Final Data Files/excel_cache"
+
+# Bump when the output of load_csv_files changes, so cached folders are read again
+DEMOGRAPHICS_CACHE_VERSION = 1
+
+# Function to read the data block of a Nomis CSV export
+def read_nomis_csv(filepath):
+    """
+    Read the rows from the "local authority" header line up to and including the Westminster row in a single pass.
+    Reading stops at the Westminster row, so the totals and footnotes are never read, and only the data block
+    has its double quotes removed before it is parsed.
+
+    The block is still copied into a StringIO for read_csv: its first and last rows are only found by their
+    content, and every double quote is stripped as before so the parsed values stay the same. Nomis files are
+    a few KB, so the copy is negligible.
+    """
+    block = []
+    with open(filepath, 'r') as file:
+        for line in file:
+            if not block and "local authority" not in line:
+                continue
+            block.append(line.replace('"', ''))
+            if "Westminster" in line:
+                break
+        else:
+            raise ValueError("no data block from the local authority header to the Westminster row")
+
+    return pd.read_csv(StringIO("".join(block)))
+
+@instrument_stage()
 def load_csv_files(directory):
     """
     Load all CSV files from a folder and merge them into a single DataFrame.
@@ -12,23 +47,12 @@ def load_csv_files(directory):
     common_columns = ['borough_code','borough_name']
     regex_pattern = re.compile(r'Numerator|Denominator|Conf', re.IGNORECASE)
 
-    for filename in os.listdir(directory):
+    for filename in sorted(os.listdir(directory)):
         print(filename)
         if filename.endswith('.csv'):
             filepath = os.path.join(directory, filename)
             try:
-                
-                with open(filepath, 'r') as file:
-                    lines = file.readlines()
-
-                start_line = next(i for i, line in enumerate(lines) if "local authority" in line)
-                end_line = next(i for i, line in enumerate(lines) if "Westminster" in line)
-
-                # Extract the CSV data from lines and remove double quotes
-                csv_data = "".join(line.replace('"', '') for line in lines[start_line:end_line+1])
-
-                # Read the CSV data using pandas from the modified CSV string
-                df = pd.read_csv(StringIO(csv_data))
+                df = read_nomis_csv(filepath)
                 
                 # rename local authority column to borough_name
                 df.rename(columns={"mnemonic":"borough_code","local authority: district / unitary (as of April 2021)":"borough_name"}, inplace=True)
@@ -51,15 +75,88 @@ def load_csv_files(directory):
                 print(f"Error reading file {filename}: {e}")
 
     if demographics:
-        # Merge DataFrames using the common columns
-        combined_demographics = pd.merge(demographics[0], demographics[1], on=common_columns, how='inner')
-        for i in range(2, len(demographics)):
-            combined_demographics = pd.merge(combined_demographics, demographics[i], on=common_columns, how='inner')
-        return combined_demographics
+        # Join all DataFrames at once on borough_code, keeping the borough_name of the first one
+        frames = [demographics[0].set_index('borough_code')]
+        frames += [df.drop(columns='borough_name').set_index('borough_code') for df in demographics[1:]]
+        combined_demographics = pd.concat(frames, axis=1, join='inner').reset_index()
+        columns = demographics[0].columns.tolist()
+        columns += [column for column in combined_demographics.columns if column not in columns]
+        return combined_demographics[columns]
     else:
         return None
+
+# Function to compute the cache key of a demographics folder
+def folder_cache_key(directory):
+    """
+    Hash the names and contents of the CSV files in directory together with DEMOGRAPHICS_CACHE_VERSION.
+    """
+    digest = hashlib.sha1(str(DEMOGRAPHICS_CACHE_VERSION).encode())
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.csv'):
+            digest.update(filename.encode())
+            with open(os.path.join(directory, filename), 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+# Function to load a demographics folder, reusing its cached output when the files are unchanged
+def load_csv_files_cached(directory, cache_dir=DEMOGRAPHICS_CACHE_DIR):
+    """
+    Return load_csv_files(directory), cached as a Parquet file named after the folder and its cache key.
+    """
+    name = os.path.basename(os.path.normpath(directory))
+    cache_file = os.path.join(cache_dir, f"{name}-{folder_cache_key(directory)}.parquet")
+    if os.path.isfile(cache_file):
+        print(f"Folder {directory} read from cache.")
+        return pd.read_parquet(cache_file)
+
+    demographics = load_csv_files(directory)
+    if demographics is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in os.listdir(cache_dir):
+            if stale.startswith(f"{name}-"):
+                os.remove(os.path.join(cache_dir, stale))
+        demographics.to_parquet(cache_file, index=False)
+    return demographics
+
+# Function to load several demographics folders in parallel
+@instrument_stage()
+def load_demographics_folders(directories, cache_dir=DEMOGRAPHICS_CACHE_DIR, max_workers=None):
+    """
+    Load every folder with load_csv_files_cached on a thread pool and return the DataFrames in the order of directories.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or len(directories)) as executor:
+        return list(executor.map(lambda directory: load_csv_files_cached(directory, cache_dir), directories))
+
+# Function to read Excel sheets through a cache of already converted sheets
+def read_excel_cached(filepath, cache_dir=EXCEL_CACHE_DIR, **read_options):
+    """
+    Return pd.read_excel(filepath, **read_options), converted once and then served from a pickle in cache_dir.
+
+    The cache file is keyed by a hash of the workbook contents and of the read options (sheet_name, usecols,
+    header, ...), so only the requested sheets and columns are converted, and a changed workbook is read again.
+    Cached conversions of older versions of the workbook are removed.
+    """
+    with open(filepath, 'rb') as file:
+        workbook_hash = hashlib.sha1(file.read()).hexdigest()[:16]
+    options_hash = hashlib.sha1(repr(sorted(read_options.items())).encode()).hexdigest()[:16]
+
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    cache_file = os.path.join(cache_dir, f"{stem}-{workbook_hash}-{options_hash}.pkl")
+    if os.path.isfile(cache_file):
+        return pd.read_pickle(cache_file)
+
+    data = pd.read_excel(filepath, **read_options)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(f"{stem}-") and not stale.startswith(f"{stem}-{workbook_hash}-"):
+            os.remove(os.path.join(cache_dir, stale))
+    pd.to_pickle(data, f"{cache_file}.tmp")
+    os.replace(f"{cache_file}.tmp", cache_file)
+    return data
     
-def load_excel_file(filepath):
+@instrument_stage()
+def load_excel_file(filepath, sheet_names=None):
     """
     Load an Excel file with 10 sheets and perform an inner join on the specific columns.
     The specific columns used for joining are: 'Upper Tier Local Authority District code (2019)'
@@ -67,6 +164,7 @@ def load_excel_file(filepath):
     
     Parameters:
         filepath (str): The path to the Excel file.
+        sheet_names (list): Only load these sheets. None loads every sheet.
         
     Returns:
         pandas.DataFrame: The merged DataFrame.
@@ -75,7 +173,7 @@ def load_excel_file(filepath):
     merged_data = None
 
     try:
-        excel_data = pd.read_excel(filepath, sheet_name=None)
+        excel_data = read_excel_cached(filepath, sheet_name=sheet_names)
         for sheet_name, sheet_data in excel_data.items():
             
             sheet_data.rename(columns={
@@ -101,6 +199,7 @@ def load_excel_file(filepath):
         print(f"Error reading the Excel file '{filepath}': {e}")
         return None
     
+@instrument_stage()
 def read_population_density(file_path):
     """
     Read the required rows of the 'population_estimates_2016_2019.xlsx' file and rename the column.
@@ -113,7 +212,7 @@ def read_population_density(file_path):
     """
     try:
         # Read the first line (local authority) and including the end line (Westminster)
-        data = pd.read_excel(file_path, skiprows=6, skipfooter=1)
+        data = read_excel_cached(file_path, skiprows=6, skipfooter=1)
 
         # Rename the column 'local authority: county / unitary (as of April 2021)' to 'borough_name'
         data.rename(columns={'local authority: county / unitary (as of April 2021)': 'borough_name'}, inplace=True)
@@ -126,10 +225,11 @@ def read_population_density(file_path):
         print(f"Error reading the Excel file '{file_path}': {e}")
         return None
     
+@instrument_stage()
 def read_house_prices(file_path):
     try:
         # Read the first line (local authority) and including the end line (Westminster)
-        data= pd.read_excel(file_path, header=1, sheet_name="Average price", usecols="A:AH")
+        data= read_excel_cached(file_path, header=1, sheet_name="Average price", usecols="A:AH")
         data.rename(columns={"Unnamed: 0":"date"},inplace=True)
         
         #extract year from date column
@@ -245,11 +345,9 @@ if __name__ == "__main__":
     
     population_file_path = "Data Files/Geographic & Demographics Data/Demographics/population_estimates_2016_2019.xlsx"
     
-    # Load all Excel sheets and merge them into a DataFrame
-    demographics_2016 = load_csv_files(folder_path_2016)
-    demographics_2017 = load_csv_files(folder_path_2017)
-    demographics_2018 = load_csv_files(folder_path_2018)
-    demographics_2019 = load_csv_files(folder_path_2019)
+    # Load the CSV files of every year folder in parallel and merge them into a DataFrame per year
+    demographics_2016, demographics_2017, demographics_2018, demographics_2019 = load_demographics_folders(
+        [folder_path_2016, folder_path_2017, folder_path_2018, folder_path_2019])
     
     indices_of_deprivation = load_excel_file(indices_file_path)
     
@@ -272,4 +370,6 @@ if __name__ == "__main__":
     demographics_data_2019.rename(columns={"2016":"population_2016","2017":"population_2017","2018":"population_2018","2019":"population_2019"},inplace=True)
     
     print(demographics_data_2019.columns)
+
+    print_stage_summary()
     
\ No newline at end of file
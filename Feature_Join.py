@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from Stage_Instrumentation import instrument_stage
+
+MONTHS = 12
+
+# Function to intern borough codes as small integers
+def intern_boroughs(*code_columns):
+    """
+    Return a sorted pandas Index of every borough code in the given columns.
+    The position of a code in the index is its integer borough id.
+    """
+    codes = pd.concat([pd.Series(column, dtype=object) for column in code_columns], ignore_index=True)
+    return pd.Index(sorted(codes.dropna().unique()), name='borough_code')
+
+# Function to build the dense borough feature table
+def build_feature_table(boroughs, years, demographics_by_year=None, house_prices=None, population=None):
+    """
+    Build a float32 array of shape (years, 12 months, boroughs + 1, features) holding every borough feature,
+    and the list of its feature names.
+
+    Parameters:
+        boroughs (pandas.Index): Interned borough codes from intern_boroughs.
+        years (list): Consecutive years covered by the table.
+        demographics_by_year (dict): Year -> load_csv_files output; each numeric column becomes a feature.
+        house_prices (pandas.DataFrame): read_house_prices output, giving house_price per year and month.
+        population (pandas.DataFrame): read_population_density output with borough_code added, giving population per year.
+
+    The last borough slot is all NaN and is used for trips whose borough is unknown.
+    """
+    first_year = years[0]
+    blocks = []
+    feature_names = []
+
+    if demographics_by_year:
+        columns = []
+        for demographics in demographics_by_year.values():
+            columns += [column for column in demographics.columns
+                        if column not in ('borough_code', 'borough_name') and column not in columns]
+        block = np.full((len(years), len(boroughs) + 1, len(columns)), np.nan, dtype=np.float32)
+        for year, demographics in demographics_by_year.items():
+            rows = boroughs.get_indexer(demographics['borough_code'])
+            values = demographics.reindex(columns=columns).apply(pd.to_numeric, errors='coerce').to_numpy(np.float32)
+            block[year - first_year, rows[rows >= 0]] = values[rows >= 0]
+        blocks.append(np.broadcast_to(block[:, None], (len(years), MONTHS) + block.shape[1:]))
+        feature_names += columns
+
+    if house_prices is not None:
+        block = np.full((len(years), MONTHS, len(boroughs) + 1, 1), np.nan, dtype=np.float32)
+        prices = house_prices[house_prices['year'].isin(years)]
+        rows = boroughs.get_indexer(prices['borough_code'])
+        known = rows >= 0
+        block[prices['year'].to_numpy()[known] - first_year, prices['month'].to_numpy()[known] - 1, rows[known], 0] = \
+            prices['house_price'].to_numpy(np.float32)[known]
+        blocks.append(block)
+        feature_names.append('house_price')
+
+    if population is not None:
+        block = np.full((len(years), len(boroughs) + 1, 1), np.nan, dtype=np.float32)
+        rows = boroughs.get_indexer(population['borough_code'])
+        for year in years:
+            if year in population.columns:
+                block[year - first_year, rows[rows >= 0], 0] = population[year].to_numpy(np.float32)[rows >= 0]
+        blocks.append(np.broadcast_to(block[:, None], (len(years), MONTHS) + block.shape[1:]))
+        feature_names.append('population')
+
+    return np.concatenate(blocks, axis=-1), feature_names
+
+# Function to turn the station -> borough mapping into an array indexed by station id
+def station_borough_ids(station_mapping, boroughs):
+    """
+    Return an int16 array where position i holds the interned borough id of bike_station_id i, or -1.
+    """
+    station_ids = station_mapping['bike_station_id'].to_numpy(dtype=np.int64)
+    station_boroughs = np.full(station_ids.max() + 1, -1, dtype=np.int16)
+    station_boroughs[station_ids] = boroughs.get_indexer(station_mapping['borough_code'].astype(object))
+    return station_boroughs
+
+# Function to attach the borough features to every trip
+@instrument_stage()
+def join_borough_features(bike_data, feature_table, station_boroughs, first_year, station_column='startstation_id',
+                          year_column='start_year', month_column='start_month'):
+    """
+    Return a float32 matrix with one row per trip and one column per feature of feature_table.
+
+    Each trip's (year, month, borough) is turned into a single row number of the flattened feature table,
+    and the matrix is filled with one gather, so no string merge or intermediate frame is needed.
+    Trips from an unknown station, borough or year get NaN features.
+    """
+    n_years, n_months, n_boroughs, n_features = feature_table.shape
+    unknown_borough = n_boroughs - 1
+
+    stations = pd.array(bike_data[station_column], dtype='Int64').to_numpy(dtype=np.int64, na_value=-1)
+    known_station = (stations >= 0) & (stations < len(station_boroughs))
+    borough = np.full(len(stations), unknown_borough, dtype=np.int64)
+    borough[known_station] = station_boroughs[stations[known_station]]
+    borough[borough < 0] = unknown_borough
+
+    year = bike_data[year_column].to_numpy(dtype=np.int64) - first_year
+    month = bike_data[month_column].to_numpy(dtype=np.int64) - 1
+    outside = (year < 0) | (year >= n_years) | (month < 0) | (month >= n_months)
+    year[outside] = 0
+    month[outside] = 0
+    borough[outside] = unknown_borough
+
+    rows = (year * n_months + month) * n_boroughs + borough
+    table = np.ascontiguousarray(feature_table).reshape(-1, n_features)
+    matrix = np.empty((len(rows), n_features), dtype=np.float32)
+    np.take(table, rows, axis=0, out=matrix)
+    return matrix
+
+
+if __name__ == "__main__":
+    from Download_Bike_Data import read_bike_data
+    from Spatial_Index import station_areas
+    import Download_Demographics_data as demographics
+
+    YEARS = [2016, 2017, 2018, 2019]
+    DEMOGRAPHICS_DIR = "Data Files/Geographic & Demographics Data/Demographics/"
+
+    demographics_by_year = dict(zip(YEARS, demographics.load_demographics_folders(
+        [f"{DEMOGRAPHICS_DIR}{year}/" for year in YEARS])))
+    house_prices = demographics.read_house_prices(f"{DEMOGRAPHICS_DIR}UK House price index.xlsx")
+    population = demographics.read_population_density(f"{DEMOGRAPHICS_DIR}population_estimates_2016_2019.xlsx")
+
+    # Population only carries borough names, take their codes from the demographics
+    names = demographics_by_year[YEARS[-1]][['borough_name', 'borough_code']]
+    population = population.merge(names, on='borough_name', how='inner')
+
+    station_mapping = station_areas(pd.read_csv('Final Data Files/2019/bike_points.csv'))
+    boroughs = intern_boroughs(*[df['borough_code'] for df in demographics_by_year.values()],
+                               house_prices['borough_code'], station_mapping['borough_code'])
+
+    feature_table, feature_names = build_feature_table(boroughs, YEARS, demographics_by_year, house_prices, population)
+    bike_data = read_bike_data(columns=['startstation_id', 'start_year', 'start_month'])
+    features = join_borough_features(bike_data, feature_table, station_borough_ids(station_mapping, boroughs), YEARS[0])
+    print("Borough features joined to trips.", features.shape, len(feature_names))
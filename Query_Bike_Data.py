@@ -0,0 +1,177 @@
+import os
+
+import duckdb
+import numpy as np
+
+from Download_Bike_Data import TRIP_STORE_PATH
+
+# Aggregations available in TripQuery.aggregate and the SQL functions they run
+AGGREGATIONS = {
+    'count': 'count',
+    'sum': 'sum',
+    'mean': 'avg',
+    'min': 'min',
+    'max': 'max',
+    'std': 'stddev_samp',
+    'median': 'median',
+    'nunique': 'count(DISTINCT {})',
+}
+
+# Function to open an in-process DuckDB connection for trip queries
+def connect(threads=None, memory_limit=None, temp_directory=None):
+    """
+    Return an in-memory DuckDB connection running on threads cores (all by default). When a query needs
+    more than memory_limit (e.g. '4GB'), DuckDB spills to temp_directory instead of failing.
+    """
+    connection = duckdb.connect()
+    connection.execute(f"SET threads = {int(threads or os.cpu_count() or 1)}")
+    if memory_limit:
+        connection.execute(f"SET memory_limit = '{memory_limit}'")
+    if temp_directory:
+        connection.execute(f"SET temp_directory = '{temp_directory}'")
+    return connection
+
+# Function to quote a column name for SQL
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+# Class that builds a query over the trip store and only runs it when the result is asked for
+class TripQuery:
+    """
+    Lazy query over the Parquet trip store.
+
+    Every method returns a new query, nothing is read until to_pandas, count or to_sql is called.
+    The query runs in DuckDB: only the partitions matching the start_year/start_month filters are
+    opened, only the columns it uses are read, and filters and aggregations are executed in
+    parallel while streaming over the store, so it does not need to fit in memory.
+
+    Example: average peak-hour duration by station in summer 2018
+        TripQuery().where(start_year=2018, start_month=[6, 7, 8], peak_hour=1) \\
+            .group_by('startstation_id').aggregate(mean_duration=('duration_minutes', 'mean')).to_pandas()
+    """
+    def __init__(self, path=TRIP_STORE_PATH, connection=None):
+        self.path = path
+        self.connection = connection
+        self.columns = None
+        self.conditions = []
+        self.parameters = []
+        self.groups = []
+        self.aggregations = {}
+        self.order = []
+        self.row_limit = None
+
+    def copy(self, **changes):
+        query = TripQuery.__new__(TripQuery)
+        query.__dict__.update(self.__dict__)
+        query.conditions = list(self.conditions)
+        query.parameters = list(self.parameters)
+        query.__dict__.update(changes)
+        return query
+
+    def select(self, *columns):
+        """
+        Only return these columns.
+        """
+        return self.copy(columns=list(columns))
+
+    def where(self, *expressions, **equals):
+        """
+        Keep the trips matching every condition. Keyword arguments compare a column with a value, or with
+        any of a list of values. Positional arguments are SQL expressions such as "duration_minutes > 30".
+        """
+        query = self.copy()
+        for column, value in equals.items():
+            if np.ndim(value) == 0:
+                query.conditions.append(f"{quote(column)} = ?")
+                query.parameters.append(value.item() if isinstance(value, np.generic) else value)
+            else:
+                values = [item.item() if isinstance(item, np.generic) else item for item in value]
+                query.conditions.append(f"{quote(column)} IN ({', '.join('?' * len(values))})")
+                query.parameters.extend(values)
+        query.conditions.extend(f"({expression})" for expression in expressions)
+        return query
+
+    def between(self, column, low, high):
+        """
+        Keep the trips where low <= column < high, e.g. a range of start_date values.
+        """
+        query = self.copy()
+        query.conditions.append(f"{quote(column)} >= ? AND {quote(column)} < ?")
+        query.parameters.extend([low, high])
+        return query
+
+    def group_by(self, *columns):
+        return self.copy(groups=list(columns))
+
+    def aggregate(self, **aggregations):
+        """
+        Aggregate per group with name=(column, function), function being one of AGGREGATIONS.
+        count may be given a column of None to count rows.
+        """
+        for name, (column, function) in aggregations.items():
+            if function not in AGGREGATIONS:
+                raise ValueError(f"Unknown aggregation {function!r} for {name}, expected one of {list(AGGREGATIONS)}")
+            if column is None and function != 'count':
+                raise ValueError(f"Aggregation {function!r} for {name} needs a column, only count can count rows")
+        return self.copy(aggregations=dict(self.aggregations, **aggregations))
+
+    def order_by(self, *columns, descending=False):
+        return self.copy(order=[f"{quote(column)}{' DESC' if descending else ''}" for column in columns])
+
+    def limit(self, rows):
+        return self.copy(row_limit=int(rows))
+
+    def to_sql(self):
+        """
+        Return the SQL statement the query runs and its parameters.
+        """
+        if self.groups and not self.aggregations:
+            raise ValueError("group_by needs an aggregate, e.g. .aggregate(trips=(None, 'count'))")
+        if self.aggregations:
+            selections = [quote(column) for column in self.groups]
+            for name, (column, function) in self.aggregations.items():
+                target = '*' if column is None else quote(column)
+                sql_function = AGGREGATIONS[function]
+                expression = sql_function.format(target) if '{}' in sql_function else f"{sql_function}({target})"
+                selections.append(f"{expression} AS {quote(name)}")
+        elif self.columns:
+            selections = [quote(column) for column in self.columns]
+        else:
+            selections = ['*']
+
+        source = os.path.join(self.path, '**', '*.parquet').replace("'", "''")
+        sql = f"SELECT {', '.join(selections)} FROM read_parquet('{source}', hive_partitioning = true, union_by_name = true)"
+        if self.conditions:
+            sql += f" WHERE {' AND '.join(self.conditions)}"
+        if self.aggregations and self.groups:
+            sql += f" GROUP BY {', '.join(quote(column) for column in self.groups)}"
+        if self.order:
+            sql += f" ORDER BY {', '.join(self.order)}"
+        elif self.aggregations and self.groups:
+            sql += f" ORDER BY {', '.join(quote(column) for column in self.groups)}"
+        if self.row_limit is not None:
+            sql += f" LIMIT {self.row_limit}"
+        return sql, list(self.parameters)
+
+    def to_pandas(self):
+        """
+        Run the query and return the result as a pandas DataFrame.
+        """
+        sql, parameters = self.to_sql()
+        connection = self.connection or connect()
+        return connection.execute(sql, parameters).df()
+
+    def count(self):
+        """
+        Return the number of trips matching the filters.
+        """
+        return int(self.copy(groups=[], aggregations={'trips': (None, 'count')}, order=[], row_limit=None)
+                   .to_pandas()['trips'].iloc[0])
+
+
+if __name__ == "__main__":
+    # Average peak-hour duration by start station in summer 2018
+    summer_2018 = TripQuery().where(start_year=2018, start_month=[6, 7, 8], peak_hour=1)
+    durations = summer_2018.group_by('startstation_id', 'startstation_name').aggregate(
+        trips=(None, 'count'), mean_duration=('duration_minutes', 'mean'))
+    print(durations.order_by('trips', descending=True).limit(10).to_pandas())
@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from Stage_Instrumentation import stage, print_stage_summary
+from Download_Bike_Data import (BUCKET_URL, RAW_TRIP_DIR, FILE_MANIFEST_FILE, TRIP_STORE_PATH, PARTS_MANIFEST_FILE,
+                                RENTAL_ID_INDEX_FILE, sync_trip_files, process_bike_data_incrementally,
+                                file_content_hash, load_manifest, save_manifest)
+
+PIPELINE_STATE_FILE = 'Final Data Files/pipeline_state.json'
+PIPELINE_WORKERS = 3
+
+BIKE_POINTS_FILE = 'Final Data Files/bike_points.csv'
+DEMOGRAPHICS_DIR = "Data Files/Geographic & Demographics Data/Demographics/"
+DEMOGRAPHICS_YEARS = [2016, 2017, 2018, 2019]
+
+# Stage functions. Modules are imported inside them so a run only loads what its stages need
+
+def run_sync_trip_files():
+    os.makedirs(RAW_TRIP_DIR, exist_ok=True)
+    sync_trip_files(BUCKET_URL, RAW_TRIP_DIR, FILE_MANIFEST_FILE)
+
+def run_process_trips():
+    process_bike_data_incrementally(RAW_TRIP_DIR)
+
+def run_demand_cube():
+    from Demand_Cube import update_demand_cube
+    update_demand_cube()
+
+def run_bike_points():
+    from Download_Bike_Points import get_bike_points, pre_process_bike_points, save_bike_points
+    save_bike_points(pre_process_bike_points(get_bike_points()))
+
+def run_station_areas():
+    from Download_Bike_Points import read_bike_points
+    from Spatial_Index import station_areas
+    station_areas(read_bike_points())
+
+def run_station_distances():
+    from Download_Bike_Points import read_bike_points
+    from Trip_Features import station_distance_matrix
+    station_distance_matrix(read_bike_points())
+
+def run_demographics():
+    import Download_Demographics_data as demographics
+    demographics.load_demographics_folders([f"{DEMOGRAPHICS_DIR}{year}/" for year in DEMOGRAPHICS_YEARS])
+    demographics.load_excel_file(f"{DEMOGRAPHICS_DIR}File_11_-_IoD2019_Local_Authority_District_Summaries__upper-tier__.xlsx")
+    demographics.read_house_prices(f"{DEMOGRAPHICS_DIR}UK House price index.xlsx")
+    demographics.read_population_density(f"{DEMOGRAPHICS_DIR}population_estimates_2016_2019.xlsx")
+
+# The pipeline as a DAG. A stage is skipped when the content of its inputs (data and code) is unchanged
+# since its last successful run and its outputs exist. Stages reading remote sources always run.
+PIPELINE_STAGES = {
+    'sync_trip_files': {
+        'function': run_sync_trip_files,
+        'depends': [],
+        'inputs': [],
+        'outputs': [RAW_TRIP_DIR, FILE_MANIFEST_FILE],
+        'always_run': True,
+    },
+    'process_trips': {
+        'function': run_process_trips,
+        'depends': ['sync_trip_files'],
+        'inputs': [RAW_TRIP_DIR, 'Download_Bike_Data.py', 'Date_Dimension.py'],
+        'outputs': [TRIP_STORE_PATH, PARTS_MANIFEST_FILE, RENTAL_ID_INDEX_FILE],
+    },
+    'demand_cube': {
+        'function': run_demand_cube,
+        'depends': ['process_trips'],
+        'inputs': [TRIP_STORE_PATH, 'Demand_Cube.py'],
+        'outputs': ['Final Data Files/demand_cube'],
+    },
+    'bike_points': {
+        'function': run_bike_points,
+        'depends': [],
+        'inputs': [],
+        'outputs': [BIKE_POINTS_FILE],
+        'always_run': True,
+    },
+    'station_areas': {
+        'function': run_station_areas,
+        'depends': ['bike_points'],
+        'inputs': [BIKE_POINTS_FILE, 'Spatial_Index.py',
+                   'Data Files/Geographic & Demographics Data/Geography/statistical-gis-boundaries-london/ESRI/'],
+        'outputs': ['Final Data Files/station_areas.csv'],
+    },
+    'station_distances': {
+        'function': run_station_distances,
+        'depends': ['bike_points'],
+        'inputs': [BIKE_POINTS_FILE, 'Trip_Features.py'],
+        'outputs': ['Final Data Files/station_distances.npz'],
+    },
+    'demographics': {
+        'function': run_demographics,
+        'depends': [],
+        'inputs': [DEMOGRAPHICS_DIR, 'Download_Demographics_data.py'],
+        'outputs': ['Final Data Files/demographics_cache', 'Final Data Files/excel_cache'],
+    },
+}
+
+# Function to list the files below a path
+def list_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, directories, filenames in os.walk(path):
+        directories.sort()
+        files += [os.path.join(root, filename) for filename in sorted(filenames)]
+    return files
+
+# Class that hashes stage inputs, remembering file hashes between runs
+class InputHasher:
+    """
+    Content hashes of files and directories. The hash of each file is kept with its size and modification
+    time, so a file is only read again when one of them changes.
+    """
+    def __init__(self, file_hashes=None):
+        self.file_hashes = dict(file_hashes or {})
+        self.lock = threading.Lock()
+
+    def file_hash(self, filepath):
+        status = os.stat(filepath)
+        with self.lock:
+            cached = self.file_hashes.get(filepath)
+        if cached and cached[0] == status.st_size and cached[1] == status.st_mtime_ns:
+            return cached[2]
+        content_hash = file_content_hash(filepath)
+        with self.lock:
+            self.file_hashes[filepath] = [status.st_size, status.st_mtime_ns, content_hash]
+        return content_hash
+
+    def inputs_hash(self, paths):
+        """
+        Return one hash over the names and contents of every file below the given paths.
+        """
+        digest = hashlib.sha1()
+        for path in paths:
+            digest.update(f"{path}\n".encode())
+            if not os.path.exists(path):
+                digest.update(b"missing\n")
+                continue
+            for filepath in list_files(path):
+                digest.update(f"{os.path.relpath(filepath, path)} {self.file_hash(filepath)}\n".encode())
+        return digest.hexdigest()
+
+# Function to find every stage downstream of the given stages
+def downstream_stages(names, stages=PIPELINE_STAGES):
+    """
+    Return the given stages and every stage that depends on them, directly or not.
+    """
+    selected = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for name, spec in stages.items():
+            if name not in selected and selected.intersection(spec['depends']):
+                selected.add(name)
+                changed = True
+    return selected
+
+# Function to check the DAG before it runs
+def check_stages(stages=PIPELINE_STAGES):
+    """
+    Raise ValueError for dependencies on unknown stages and for cycles.
+    """
+    for name, spec in stages.items():
+        for dependency in spec['depends']:
+            if dependency not in stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+
+    visiting, done = set(), set()
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage {name} is part of a dependency cycle")
+        visiting.add(name)
+        for dependency in stages[name]['depends']:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+    for name in stages:
+        visit(name)
+
+# Function to run the pipeline
+def run_pipeline(only=None, from_stage=None, force=False, stages=PIPELINE_STAGES, state_file=PIPELINE_STATE_FILE,
+                 max_workers=PIPELINE_WORKERS):
+    """
+    Run the stages of the DAG, each as soon as the stages it depends on have finished, with independent
+    branches running at the same time on max_workers threads.
+
+    Parameters:
+        only (list): Run just these stages, even if their inputs are unchanged.
+        from_stage (str): Run this stage, even if its inputs are unchanged, and every stage downstream of it.
+        force (bool): Run every selected stage regardless of its inputs.
+
+    Stages outside the selection are not run; a stage whose dependency was not run uses the outputs
+    already on disk. A stage whose dependency failed is not run. Returns a dict of stage name to
+    'ran', 'skipped', 'failed' or 'blocked'.
+    """
+    check_stages(stages)
+    for name in (only or []) + ([from_stage] if from_stage else []):
+        if name not in stages:
+            raise ValueError(f"Unknown stage {name}, expected one of {list(stages)}")
+
+    if only:
+        selected, forced = set(only), set(only)
+    elif from_stage:
+        selected, forced = downstream_stages([from_stage], stages), {from_stage}
+    else:
+        selected, forced = set(stages), set()
+    if force:
+        forced = set(selected)
+
+    state = load_manifest(state_file)
+    hasher = InputHasher(state.get('file_hashes'))
+    stage_state = state.setdefault('stages', {})
+
+    def run_stage(name):
+        spec = stages[name]
+        inputs_hash = hasher.inputs_hash(spec['inputs'])
+        previous = stage_state.get(name, {})
+        up_to_date = (not spec.get('always_run') and previous.get('inputs_hash') == inputs_hash
+                      and all(os.path.exists(output) for output in spec['outputs']))
+        if up_to_date and name not in forced:
+            return 'skipped', inputs_hash
+
+        with stage(f"pipeline:{name}"):
+            spec['function']()
+        # Hash again after the run, so a stage that writes into its own inputs is not rerun next time
+        return 'ran', hasher.inputs_hash(spec['inputs'])
+
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for name in stages:
+                if name not in selected or name in results or name in running.values():
+                    continue
+                dependencies = [dependency for dependency in stages[name]['depends'] if dependency in selected]
+                if any(results.get(dependency) in ('failed', 'blocked') for dependency in dependencies):
+                    results[name] = 'blocked'
+                    print(f"Stage {name} not run because a stage it depends on failed.")
+                elif all(dependency in results for dependency in dependencies):
+                    print(f"Stage {name} started.")
+                    running[executor.submit(run_stage, name)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    status, inputs_hash = future.result()
+                    stage_state[name] = {'inputs_hash': inputs_hash, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                    results[name] = status
+                    print(f"Stage {name} {status}.")
+                except Exception as e:
+                    results[name] = 'failed'
+                    print(f"Stage {name} failed: {e}")
+
+                state['file_hashes'] = hasher.file_hashes
+                save_manifest(state, state_file)
+
+    # Forget the hashes of files that are gone
+    state['file_hashes'] = {filepath: cached for filepath, cached in hasher.file_hashes.items() if os.path.exists(filepath)}
+    save_manifest(state, state_file)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bike sharing data pipeline.")
+    parser.add_argument('--only', nargs='+', metavar='STAGE', help="run only these stages")
+    parser.add_argument('--from-stage', metavar='STAGE', help="run this stage and every stage downstream of it")
+    parser.add_argument('--force', action='store_true', help="run the selected stages even if their inputs are unchanged")
+    parser.add_argument('--workers', type=int, default=PIPELINE_WORKERS, help="number of stages run at the same time")
+    parser.add_argument('--list', action='store_true', help="list the stages and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, spec in PIPELINE_STAGES.items():
+            print(f"{name:<20} depends on: {', '.join(spec['depends']) or '-'}")
+        sys.exit(0)
+
+    results = run_pipeline(only=args.only, from_stage=args.from_stage, force=args.force, max_workers=args.workers)
+    print_stage_summary()
+    sys.exit(1 if any(status in ('failed', 'blocked') for status in results.values()) else 0)
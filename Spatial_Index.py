@@ -0,0 +1,126 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+
+from Stage_Instrumentation import instrument_stage
+
+BOUNDARY_DIR = 'Data Files/Geographic & Demographics Data/Geography/statistical-gis-boundaries-london/ESRI/'
+STATION_AREAS_FILE = 'Final Data Files/station_areas.csv'
+
+# The boundary shapefiles' ESRI British_National_Grid .prj is read as an unnamed CRS rather than
+# EPSG:27700, so the CRS is set explicitly to get the proper transformation from WGS84
+BOUNDARY_CRS = 'EPSG:27700'
+
+# Shapefile, code column and name column of each boundary level
+BOUNDARY_LAYERS = {
+    'borough': ('London_Borough_Excluding_MHW.shp', 'GSS_CODE', 'NAME'),
+    'ward': ('London_Ward_CityMerged.shp', 'GSS_CODE', 'NAME'),
+    'lsoa': ('LSOA_2011_London_gen_MHW.shp', 'LSOA11CD', 'LSOA11NM'),
+}
+
+# Function to load the polygons of a boundary level
+@lru_cache(maxsize=None)
+def load_boundaries(level, boundary_dir=BOUNDARY_DIR):
+    """
+    Read the shapefile of the given level ('borough', 'ward' or 'lsoa') with only its code, name and geometry.
+    The STR-tree spatial index of the returned GeoDataFrame is built once and kept with it.
+    """
+    filename, code_column, name_column = BOUNDARY_LAYERS[level]
+    boundaries = gpd.read_file(os.path.join(boundary_dir, filename), columns=[code_column, name_column])
+    boundaries = boundaries.set_crs(BOUNDARY_CRS, allow_override=True)
+    boundaries = boundaries.rename(columns={code_column: f'{level}_code', name_column: f'{level}_name'})
+    boundaries.sindex
+    return boundaries
+
+# Function to get the categorical dtype of an area code or name column
+def area_dtype(level, column, boundary_dir=BOUNDARY_DIR):
+    """
+    Return a CategoricalDtype of every sorted value of column in the boundaries of level, so areas
+    have the same categories whether they were assigned or read back from the cache.
+    """
+    return pd.CategoricalDtype(sorted(load_boundaries(level, boundary_dir)[column].dropna().unique()))
+
+# Function to assign points to the boundaries that contain them
+def assign_points(longitude, latitude, levels=('borough', 'ward', 'lsoa'), boundary_dir=BOUNDARY_DIR):
+    """
+    Return a DataFrame with the code and name of the borough/ward/LSOA containing each WGS84 point.
+
+    The distinct points are projected to British National Grid in one call and queried against the
+    STR-tree of each level in bulk. A point on the border of two areas is given the first of them;
+    points outside London get missing values.
+    """
+    # Trip endpoints repeat the same station coordinates, so each distinct point is only looked up once
+    coordinates = np.asarray(longitude, dtype=float) + 1j * np.asarray(latitude, dtype=float)
+    inverse, coordinates = pd.factorize(coordinates)
+
+    transformer = Transformer.from_crs('EPSG:4326', BOUNDARY_CRS, always_xy=True)
+    x, y = transformer.transform(coordinates.real, coordinates.imag)
+    points = shapely.points(x, y)
+
+    areas = pd.DataFrame(index=pd.RangeIndex(len(inverse)))
+    for level in levels:
+        boundaries = load_boundaries(level, boundary_dir)
+        point_index, area_index = boundaries.sindex.query(points, predicate='within')
+
+        # Keep the first area found for each point
+        point_index, first = np.unique(point_index, return_index=True)
+        positions = np.full(len(points), -1)
+        positions[point_index] = area_index[first]
+
+        # Areas are returned as categoricals of area_dtype, taking each area's category code by position
+        positions = positions[inverse]
+        for column in (f'{level}_code', f'{level}_name'):
+            dtype = area_dtype(level, column, boundary_dir)
+            area_codes = dtype.categories.get_indexer(boundaries[column])
+            codes = np.where(positions < 0, -1, area_codes[positions])
+            areas[column] = pd.Categorical.from_codes(codes, dtype=dtype)
+    return areas
+
+# Function to map the bike stations to boroughs, wards and LSOAs, reusing the cached mapping
+@instrument_stage()
+def station_areas(bike_points, cache_file=STATION_AREAS_FILE):
+    """
+    Return the borough/ward/LSOA of every station in bike_points, keyed by bike_station_id.
+
+    The mapping is cached in cache_file together with the coordinates it was computed for;
+    only stations that are new or have moved are assigned again. Areas are returned as categoricals
+    whether they were read from the cache or assigned.
+    """
+    stations = bike_points[['bike_station_id', 'station_longitude', 'station_latitude']].drop_duplicates('bike_station_id')
+
+    if os.path.isfile(cache_file):
+        cached = pd.read_csv(cache_file)
+        for level in BOUNDARY_LAYERS:
+            for column in (f'{level}_code', f'{level}_name'):
+                cached[column] = cached[column].astype(area_dtype(level, column))
+        cached = stations.merge(cached, on=['bike_station_id', 'station_longitude', 'station_latitude'])
+    else:
+        cached = None
+
+    if cached is None:
+        missing = stations
+    else:
+        missing = stations[~stations['bike_station_id'].isin(cached['bike_station_id'])]
+
+    if len(missing) > 0:
+        assigned = assign_points(missing['station_longitude'], missing['station_latitude'])
+        assigned = pd.concat([missing.reset_index(drop=True), assigned], axis=1)
+        mapping = assigned if cached is None else pd.concat([cached, assigned], ignore_index=True)
+        mapping = mapping.sort_values('bike_station_id', ignore_index=True)
+        mapping.to_csv(cache_file, index=False)
+        print(f"Assigned {len(missing)} stations to boroughs, wards and LSOAs.")
+    else:
+        mapping = cached.sort_values('bike_station_id', ignore_index=True)
+
+    return mapping
+
+
+if __name__ == "__main__":
+    bike_points = pd.read_csv('Final Data Files/2019/bike_points.csv')
+    station_mapping = station_areas(bike_points)
+    print("Station areas saved to CSV file.", station_mapping.shape)
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Settings for the instrumentation; STAGE_LOG_FILE and STAGE_PROFILE_DIR can also be set in the environment
+INSTRUMENTATION = {
+    'enabled': True,
+    'log_file': os.environ.get('STAGE_LOG_FILE'),
+    'profile_dir': os.environ.get('STAGE_PROFILE_DIR'),
+}
+
+# Every stage recorded in this process, in the order the stages finished
+STAGE_RECORDS = []
+
+_records_lock = threading.Lock()
+_stages = threading.local()
+# Number of stages running in all threads; the peak RSS is only reset when none is
+_active_stages = 0
+
+# Function to change the instrumentation settings
+def configure_instrumentation(log_file=None, profile_dir=None, enabled=True):
+    """
+    Set where stage records are written as JSON lines (log_file), where cProfile output of each
+    outermost stage is saved (profile_dir), and whether stages are recorded at all.
+    """
+    INSTRUMENTATION.update(enabled=enabled, log_file=log_file, profile_dir=profile_dir)
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+# Function to reset the peak resident set size of this process
+def reset_peak_rss():
+    """
+    Reset the high-water mark of the resident set size, so peak_rss_mb reports the peak since this call.
+    Only Linux supports this; elsewhere peak_rss_mb keeps reporting the peak of the whole process.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+# Function to read the peak resident set size of this process
+def peak_rss_mb():
+    """
+    Return the peak resident set size in MB, counting every allocation (NumPy, Arrow and the parser alike).
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+# Function to read how many bytes this process has read and written
+def io_counters():
+    """
+    Return (bytes read, bytes written) by this process through files and sockets, or (None, None) where
+    /proc/self/io is not available.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as file:
+            for line in file:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        return None, None
+    return counters.get('rchar'), counters.get('wchar')
+
+# Function to count the rows of a stage's input or output
+def count_rows(value):
+    """
+    Return the number of rows of a DataFrame or array, or of the first DataFrame in a tuple or list, else None.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            if isinstance(item, pd.DataFrame):
+                return len(item)
+    return None
+
+# Function to store a finished stage record
+def emit_record(record):
+    with _records_lock:
+        STAGE_RECORDS.append(record)
+        if INSTRUMENTATION['log_file']:
+            with open(INSTRUMENTATION['log_file'], 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+# Context manager that records one stage
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Record the duration, rows in/out, bytes read/written and peak RSS of the code in the with block.
+
+    Yields the record, so the block can set record['rows_out'] itself. Bytes and peak RSS are measured
+    for the whole process. The peak is reset only when a stage starts while no other stage is running
+    in any thread, so it never cuts short the measurement of an enclosing or concurrent stage; the peak
+    of a nested or concurrent stage therefore includes the peak of the stages around it so far.
+    """
+    global _active_stages
+    if not INSTRUMENTATION['enabled']:
+        yield {}
+        return
+
+    stack = getattr(_stages, 'stack', None)
+    if stack is None:
+        stack = _stages.stack = []
+
+    record = {'stage': name, 'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': None, 'rows_in': rows_in,
+              'rows_out': None, 'bytes_read': None, 'bytes_written': None, 'peak_rss_mb': 0.0, 'status': 'ok'}
+    # Only one profiler can run at a time, so only the outermost stage of the main thread is profiled
+    profile = INSTRUMENTATION['profile_dir'] and not stack and threading.current_thread() is threading.main_thread()
+    profiler = cProfile.Profile() if profile else None
+    stack.append(record)
+
+    read_before, written_before = io_counters()
+    with _records_lock:
+        if not _active_stages:
+            reset_peak_rss()
+        _active_stages += 1
+    began = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'error'
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['seconds'] = time.perf_counter() - began
+        read_after, written_after = io_counters()
+        if read_before is not None:
+            record['bytes_read'] = read_after - read_before
+            record['bytes_written'] = written_after - written_before
+        record['peak_rss_mb'] = peak_rss_mb()
+        with _records_lock:
+            _active_stages -= 1
+
+        stack.pop()
+        emit_record(record)
+        if profiler is not None:
+            # The directory may only have been given through STAGE_PROFILE_DIR, so make sure it exists;
+            # a profile that cannot be saved must not replace the stage's result or exception
+            try:
+                os.makedirs(INSTRUMENTATION['profile_dir'], exist_ok=True)
+                profiler.dump_stats(os.path.join(INSTRUMENTATION['profile_dir'],
+                                                 f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.prof"))
+            except OSError as e:
+                print(f"Could not save the profile of stage {name}: {e}")
+
+# Decorator that records every call of a function as a stage
+def instrument_stage(name=None):
+    """
+    Wrap a function so each call is recorded with stage(). rows_in is taken from the first argument
+    and rows_out from the return value, when they are DataFrames.
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, count_rows(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+# Function to summarise the recorded stages
+def stage_summary(records=None):
+    """
+    Return a DataFrame with one row per stage name: calls, total seconds, the largest peak RSS,
+    rows in/out, bytes read/written and the number of failed calls.
+    """
+    records = pd.DataFrame(STAGE_RECORDS if records is None else records)
+    if records.empty:
+        return records
+    grouped = records.groupby('stage', sort=False)
+    summary = grouped.agg(calls=('stage', 'size'), seconds=('seconds', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+    # Counts that were not measured stay missing instead of adding up to 0
+    for column in ('rows_in', 'rows_out', 'bytes_read', 'bytes_written'):
+        summary[column] = grouped[column].sum(min_count=1)
+    summary['errors'] = grouped['status'].agg(lambda status: int((status == 'error').sum()))
+    return summary
+
+# Function to print the summary table of the recorded stages
+def print_stage_summary(records=None):
+    summary = stage_summary(records)
+    if summary.empty:
+        print("No stages recorded.")
+        return
+
+    def number(value, scale=1, digits=0):
+        return '-' if pd.isna(value) else f"{value / scale:,.{digits}f}"
+
+    print(f"{'stage':<34}{'calls':>6}{'errors':>7}{'seconds':>10}{'rows in':>13}{'rows out':>13}"
+          f"{'MB read':>10}{'MB written':>11}{'peak MB':>9}")
+    for row in summary.itertuples():
+        print(f"{row.Index:<34}{row.calls:>6}{row.errors:>7}{row.seconds:>10.2f}{number(row.rows_in):>13}"
+              f"{number(row.rows_out):>13}{number(row.bytes_read, 2 ** 20, 1):>10}{number(row.bytes_written, 2 ** 20, 1):>11}"
+              f"{row.peak_rss_mb:>9,.0f}")
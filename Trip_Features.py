@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from Stage_Instrumentation import instrument_stage
+
+BIKE_POINTS_FILE = 'Final Data Files/bike_points.csv'
+STATION_DISTANCES_FILE = 'Final Data Files/station_distances.npz'
+
+# Mean radius of the Earth in kilometres
+EARTH_RADIUS_KM = 6371.0088
+
+# Function to turn the station coordinates into arrays indexed by station id
+def station_coordinate_arrays(bike_points):
+    """
+    Return (latitude, longitude) arrays in radians where position i holds the coordinates of
+    bike_station_id i. Ids without a station are NaN.
+    """
+    station_ids = bike_points['bike_station_id'].to_numpy(dtype=np.int64)
+    latitude = np.full(station_ids.max() + 1, np.nan)
+    longitude = np.full(station_ids.max() + 1, np.nan)
+    latitude[station_ids] = np.radians(bike_points['station_latitude'].to_numpy(dtype=float))
+    longitude[station_ids] = np.radians(bike_points['station_longitude'].to_numpy(dtype=float))
+    return latitude, longitude
+
+# Function to compute the great-circle distance between points
+def haversine_distance(latitude1, longitude1, latitude2, longitude2):
+    """
+    Return the haversine distance in kilometres between points given in radians.
+    """
+    a = (np.sin((latitude2 - latitude1) / 2) ** 2
+         + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+# Function to compute the initial bearing from one point to another
+def initial_bearing(latitude1, longitude1, latitude2, longitude2):
+    """
+    Return the compass bearing in degrees (0-360) from the first to the second point, given in radians.
+    """
+    delta = longitude2 - longitude1
+    x = np.sin(delta) * np.cos(latitude2)
+    y = np.cos(latitude1) * np.sin(latitude2) - np.sin(latitude1) * np.cos(latitude2) * np.cos(delta)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+# Function to load or build the station-pair distance matrix
+def station_distance_matrix(bike_points, cache_file=STATION_DISTANCES_FILE):
+    """
+    Return a square float32 matrix of haversine distances in kilometres, indexed by start and end bike_station_id.
+
+    The matrix is cached in cache_file together with the coordinates it was built from, and is
+    rebuilt only when the station coordinates change.
+    """
+    latitude, longitude = station_coordinate_arrays(bike_points)
+
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as cached:
+            if (np.array_equal(cached['latitude'], latitude, equal_nan=True)
+                    and np.array_equal(cached['longitude'], longitude, equal_nan=True)):
+                return cached['distances']
+
+    distances = haversine_distance(latitude[:, None], longitude[:, None], latitude[None, :], longitude[None, :])
+    distances = distances.astype(np.float32)
+    np.savez(cache_file, latitude=latitude, longitude=longitude, distances=distances)
+    print("Station distance matrix saved.", distances.shape)
+    return distances
+
+# Function to turn station id columns into positions in the coordinate arrays
+def station_positions(station_ids, n_stations):
+    """
+    Return the station ids as int64 positions, with 0 for missing ids or ids that have no coordinates,
+    and the mask of those unknown ids.
+    """
+    ids = pd.array(station_ids, dtype='Int64')
+    unknown = np.asarray(ids.isna())
+    positions = ids.to_numpy(dtype=np.int64, na_value=0)
+    unknown |= (positions < 0) | (positions >= n_stations)
+    positions[unknown] = 0
+    return positions, unknown
+
+# Function to add origin-destination features to the trips
+@instrument_stage()
+def add_trip_features(bike_data, bike_points, distances=None):
+    """
+    Add distance_km, bearing_degrees and speed_kmh to the processed trips.
+
+    Each feature is one gather from the arrays indexed by station id, so no merge with bike_points
+    is needed. Trips whose start or end station has no coordinates, and the speed of trips with no
+    duration, are NaN. Round trips have a distance of 0.
+    """
+    if distances is None:
+        distances = station_distance_matrix(bike_points)
+    latitude, longitude = station_coordinate_arrays(bike_points)
+
+    start, start_unknown = station_positions(bike_data['startstation_id'], len(latitude))
+    end, end_unknown = station_positions(bike_data['endstation_id'], len(latitude))
+    unknown = start_unknown | end_unknown
+
+    distance = distances[start, end]
+    distance[unknown] = np.nan
+    bearing = initial_bearing(latitude[start], longitude[start], latitude[end], longitude[end]).astype(np.float32)
+    bearing[unknown] = np.nan
+
+    duration = pd.array(bike_data['duration'], dtype='Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(duration > 0, distance / (duration / 3600), np.nan).astype(np.float32)
+
+    bike_data['distance_km'] = distance
+    bike_data['bearing_degrees'] = bearing
+    bike_data['speed_kmh'] = speed
+    print("Trip distance, bearing and speed columns created.")
+    return bike_data
+
+
+if __name__ == "__main__":
+    from Download_Bike_Data import read_bike_data
+
+    bike_points = pd.read_csv(BIKE_POINTS_FILE)
+    bike_data = read_bike_data(columns=['rental_id', 'duration', 'startstation_id', 'endstation_id'])
+    bike_data = add_trip_features(bike_data, bike_points)
+    print(bike_data[['distance_km', 'bearing_degrees', 'speed_kmh']].describe())